@@ -242,6 +242,11 @@ std::istream& operator>>(std::istream& is, Complex& p) {
   if (!(is >> y)) {
     return is;
   }
+  // Reject zero denominators, which make GMP abort.
+  if (x.get_den() == 0 || y.get_den() == 0) {
+    is.setstate(std::ios_base::failbit);
+    return is;
+  }
   x.canonicalize();
   y.canonicalize();
   p = Complex(x, y);
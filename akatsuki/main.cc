@@ -14,8 +14,12 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
+#include <exception>
 #include <fstream>
 #include <iostream>
+#include <sstream>
+#include <string>
+#include <vector>
 
 #include <gflags/gflags.h>
 #include <glog/logging.h>
@@ -29,32 +33,111 @@
 
 DEFINE_bool(compile, false, "Mode flag: compiles a solution to a problem.");
 DEFINE_bool(evaluate, false, "Mode flag: evaluates a solution.");
+DEFINE_bool(server, false,
+            "Mode flag: serves framed compile/evaluate requests on stdin.");
 
 namespace akatsuki {
 
-int CompileMain(const char* solution_path) {
+// Malformed specs are reported like invalid solutions instead of CHECK
+// failures, so that a bad request does not kill the server mode process.
+bool RunCompile(std::istream& solution_is) {
   SolutionSpec solution_spec;
-  CHECK(std::ifstream(solution_path) >> solution_spec) << "Malformed solution.";
+  if (!(solution_is >> solution_spec)) {
+    std::cout << "ValidateSolutionError: Malformed solution." << std::endl;
+    return false;
+  }
   if (!ValidateSolution(solution_spec, true)) {
     std::cout << "Invalid solution.\n";
-    exit(1);
+    return false;
   }
   ProblemSpec problem_spec = CompileProblem(solution_spec);
   CHECK(std::cout << problem_spec) << "Failed to write problem.";
-  return 0;
+  return true;
 }
 
-int EvaluateMain(const char* problem_path, const char* solution_path) {
+bool RunEvaluate(std::istream& problem_is, std::istream& solution_is) {
   ProblemSpec problem_spec;
-  CHECK(std::ifstream(problem_path) >> problem_spec) << "Malformed problem.";
+  if (!(problem_is >> problem_spec)) {
+    std::cout << "Malformed problem." << std::endl;
+    return false;
+  }
   SolutionSpec solution_spec;
-  CHECK(std::ifstream(solution_path) >> solution_spec) << "Malformed solution.";
+  if (!(solution_is >> solution_spec)) {
+    std::cout << "ValidateSolutionError: Malformed solution." << std::endl;
+    return false;
+  }
   if (!ValidateSolution(solution_spec, false)) {
     std::cout << "Invalid solution.\n";
-    exit(1);
+    return false;
   }
   int resemblance_int = Evaluate(problem_spec, solution_spec);
   std::cout << "integer_resemblance: " << resemblance_int << std::endl;
+  return true;
+}
+
+int CompileMain(const char* solution_path) {
+  std::ifstream solution_is(solution_path);
+  return RunCompile(solution_is) ? 0 : 1;
+}
+
+int EvaluateMain(const char* problem_path, const char* solution_path) {
+  std::ifstream problem_is(problem_path);
+  std::ifstream solution_is(solution_path);
+  return RunEvaluate(problem_is, solution_is) ? 0 : 1;
+}
+
+// Serves requests until stdin is closed.
+//
+// Each request is a header line "<command> <length>...\n" followed by
+// payloads of the given lengths, where <command> is one of:
+//   ping
+//   compile <solution-length>
+//   evaluate <problem-length> <solution-length>
+// Each response is a header line "<ok|error> <length>\n" followed by the
+// output the corresponding one-shot mode would write to stdout.
+int ServerMain() {
+  std::string header;
+  while (std::getline(std::cin, header)) {
+    std::istringstream header_is(header);
+    std::string command;
+    CHECK(header_is >> command) << "Malformed request header.";
+    std::vector<std::string> payloads;
+    size_t length;
+    while (header_is >> length) {
+      std::string payload(length, '\0');
+      CHECK(std::cin.read(&payload[0], length)) << "Truncated request.";
+      payloads.push_back(payload);
+    }
+
+    // Validator and compiler write results to std::cout, so capture them.
+    std::ostringstream output;
+    std::streambuf* stdout_buf = std::cout.rdbuf(output.rdbuf());
+    bool ok = false;
+    try {
+      if (command == "ping" && payloads.size() == 0) {
+        ok = true;
+      } else if (command == "compile" && payloads.size() == 1) {
+        std::istringstream solution_is(payloads[0]);
+        ok = RunCompile(solution_is);
+      } else if (command == "evaluate" && payloads.size() == 2) {
+        std::istringstream problem_is(payloads[0]);
+        std::istringstream solution_is(payloads[1]);
+        ok = RunEvaluate(problem_is, solution_is);
+      } else {
+        std::cout << "Unknown request: " << header << std::endl;
+      }
+    } catch (const std::exception& e) {
+      // E.g. std::bad_alloc on huge specs. Report it and serve the next
+      // request.
+      ok = false;
+      std::cout << "Internal error: " << e.what() << std::endl;
+    }
+    std::cout.rdbuf(stdout_buf);
+
+    const std::string body = output.str();
+    std::cout << (ok ? "ok" : "error") << " " << body.size() << "\n"
+              << body << std::flush;
+  }
   return 0;
 }
 
@@ -62,10 +145,12 @@ void PrintUsage() {
   std::cerr << "Usage:" << std::endl;
   std::cerr << "  akatsuki --compile <solution>" << std::endl;
   std::cerr << "  akatsuki --evaluate <problem> <solution>" << std::endl;
+  std::cerr << "  akatsuki --server" << std::endl;
 }
 
 int Main(int argc, char** argv) {
-  int num_modes = int(FLAGS_compile) + int(FLAGS_evaluate);
+  int num_modes =
+      int(FLAGS_compile) + int(FLAGS_evaluate) + int(FLAGS_server);
   if (num_modes != 1) {
     PrintUsage();
     return 1;
@@ -83,6 +168,12 @@ int Main(int argc, char** argv) {
       return 1;
     }
     return EvaluateMain(argv[1], argv[2]);
+  } else if (FLAGS_server) {
+    if (argc != 1) {
+      PrintUsage();
+      return 1;
+    }
+    return ServerMain();
   }
   LOG(FATAL) << "what?";
   return 1;
@@ -23,12 +23,20 @@ std::istream& operator>>(std::istream& is, ProblemSpec& spec) {
   if (!(is >> n)) {
     return is;
   }
+  if (n < 0) {
+    is.setstate(std::ios_base::failbit);
+    return is;
+  }
   spec.polygons.resize(n);
   for (int i = 0; i < n; ++i) {
     int m;
     if (!(is >> m)) {
       return is;
     }
+    if (m < 0) {
+      is.setstate(std::ios_base::failbit);
+      return is;
+    }
     Polygon& polygon = spec.polygons[i];
     polygon.resize(m);
     for (int j = 0; j < m; ++j) {
@@ -41,6 +49,10 @@ std::istream& operator>>(std::istream& is, ProblemSpec& spec) {
   if (!(is >> e)) {
     return is;
   }
+  if (e < 0) {
+    is.setstate(std::ios_base::failbit);
+    return is;
+  }
   spec.edges.resize(e);
   for (int i = 0; i < e; ++i) {
     Complex a, b;
@@ -23,6 +23,10 @@ std::istream& operator>>(std::istream& is, SolutionSpec& spec) {
   if (!(is >> n)) {
     return is;
   }
+  if (n < 0) {
+    is.setstate(std::ios_base::failbit);
+    return is;
+  }
   spec.src_points.resize(n);
   for (int i = 0; i < n; ++i) {
     if (!(is >> spec.src_points[i])) {
@@ -33,17 +37,29 @@ std::istream& operator>>(std::istream& is, SolutionSpec& spec) {
   if (!(is >> m)) {
     return is;
   }
+  if (m < 0) {
+    is.setstate(std::ios_base::failbit);
+    return is;
+  }
   spec.facet_defs.resize(m);
   for (int i = 0; i < m; ++i) {
     int k;
     if (!(is >> k)) {
       return is;
     }
+    if (k < 0) {
+      is.setstate(std::ios_base::failbit);
+      return is;
+    }
     spec.facet_defs[i].resize(k);
     for (int j = 0; j < k; ++j) {
       if (!(is >> spec.facet_defs[i][j])) {
         return is;
       }
+      if (spec.facet_defs[i][j] < 0 || spec.facet_defs[i][j] >= n) {
+        is.setstate(std::ios_base::failbit);
+        return is;
+      }
     }
   }
   spec.dst_points.resize(n);
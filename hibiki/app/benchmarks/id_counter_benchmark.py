@@ -0,0 +1,191 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures contention of solution registration with various --id_block_size.
+
+Worker processes register solutions concurrently like app processes, and
+count the updates to counter documents in the config collection, which
+every process contends for. This uses a scratch database on a running
+MongoDB server, so never point it to a production database.
+
+Usage:
+    PYTHONPATH=. python benchmarks/id_counter_benchmark.py \
+        --mongodb_url=mongodb://localhost
+"""
+
+import multiprocessing
+import sys
+import threading
+import time
+
+import gflags
+import pymongo
+
+from hibiki import model
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string(
+    'benchmark_mongodb_db', 'hibiki_id_counter_benchmark',
+    'Scratch MongoDB database name. It is dropped on start.')
+gflags.DEFINE_integer(
+    'benchmark_processes', 8,
+    'Number of worker processes.')
+gflags.DEFINE_integer(
+    'benchmark_threads', 8,
+    'Number of threads in each worker process.')
+gflags.DEFINE_integer(
+    'benchmark_solutions_per_thread', 500,
+    'Number of solutions registered by each thread.')
+gflags.DEFINE_list(
+    'benchmark_block_sizes', ['1', '10', '100'],
+    'Values of --id_block_size to compare.')
+
+# Settings required by hibiki.settings, chosen to make a valid contest.
+_DEFAULT_ARGS = [
+    '--contest_start_time=0',
+    '--contest_first_publish_time=0',
+    '--contest_freeze_time=86400',
+    '--contest_last_publish_time=86400',
+    '--contest_end_time=86400',
+    '--contest_primary_snapshot_interval=3600',
+    '--contest_secondary_snapshot_interval=600',
+    '--api_rate_limit_window_size=3600',
+    '--api_rate_limit_submissions_in_window=1000',
+    '--api_rate_limit_blob_lookups_in_window=1000',
+    '--admin_password=benchmark',
+]
+
+_PROBLEM_ID = 1
+
+
+def _connect():
+    model._client = pymongo.MongoClient(FLAGS.mongodb_url)
+    model._db = model._client[FLAGS.mongodb_db]
+
+
+# The number of updates to counter documents in the worker process.
+_counter_updates = [0]
+_counter_updates_lock = threading.Lock()
+
+
+def _count_config_writes(method):
+    def wrapper(self, *args, **kwargs):
+        if self.name == 'config':
+            with _counter_updates_lock:
+                _counter_updates[0] += 1
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def init_worker():
+    """Counts writes to the config collection in a worker process."""
+    for name in ('update_one', 'find_one_and_update'):
+        method = getattr(pymongo.collection.Collection, name)
+        setattr(pymongo.collection.Collection, name,
+                _count_config_writes(method))
+    # Connect after fork, as MongoClient is not fork-safe.
+    _connect()
+
+
+def run_worker(block_size):
+    """Registers solutions in a worker process.
+
+    Returns:
+        (solution_ids, counter_updates)
+    """
+    FLAGS.id_block_size = block_size
+    _counter_updates[0] = 0
+    solution_ids = []
+
+    def register():
+        for i in xrange(FLAGS.benchmark_solutions_per_thread):
+            solution = model.register_solution(
+                owner='benchmark',
+                problem_id=_PROBLEM_ID,
+                problem_spec_hash='0' * 40,
+                solution_spec='0\n%d\n' % i,
+                solution_size=4,
+                resemblance_int=0,
+                processing_time=0.0)
+            solution_ids.append(solution['_id'])
+    threads = [
+        threading.Thread(target=register)
+        for _ in xrange(FLAGS.benchmark_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (solution_ids, _counter_updates[0])
+
+
+def run_benchmark(block_size):
+    """Runs workers with a block size.
+
+    Returns:
+        (elapsed_time, counter_updates, solution_ids, unapplied_count)
+    """
+    client = pymongo.MongoClient(FLAGS.mongodb_url)
+    db = client[FLAGS.mongodb_db]
+    db.solutions.delete_many({})
+    db.config.update_one({'_id': 'solution_count'}, {'$set': {'value': 0}})
+    pool = multiprocessing.Pool(
+        FLAGS.benchmark_processes, initializer=init_worker)
+    try:
+        start_time = time.time()
+        results = pool.map(
+            run_worker, [block_size] * FLAGS.benchmark_processes)
+        elapsed_time = time.time() - start_time
+    finally:
+        pool.close()
+        pool.join()
+    solution_ids = [id for worker_ids, _ in results for id in worker_ids]
+    counter_updates = sum(updates for _, updates in results)
+    # Batched additions to the solution count left in the exited workers.
+    unapplied_count = (
+        len(solution_ids) -
+        db.config.find_one({'_id': 'solution_count'})['value'])
+    return (elapsed_time, counter_updates, solution_ids, unapplied_count)
+
+
+def main(argv):
+    FLAGS(argv[:1] + _DEFAULT_ARGS + argv[1:])
+    FLAGS.mongodb_db = FLAGS.benchmark_mongodb_db
+    client = pymongo.MongoClient(FLAGS.mongodb_url)
+    client.drop_database(FLAGS.mongodb_db)
+    _connect()
+    model._init_model()
+
+    total_solutions = (
+        FLAGS.benchmark_processes * FLAGS.benchmark_threads *
+        FLAGS.benchmark_solutions_per_thread)
+    print '%d processes x %d threads, %d solutions in total' % (
+        FLAGS.benchmark_processes, FLAGS.benchmark_threads, total_solutions)
+    print '%-12s %12s %16s %12s %16s' % (
+        'block size', 'time (s)', 'counter updates', 'solutions/s',
+        'unapplied count')
+    for block_size in FLAGS.benchmark_block_sizes:
+        block_size = int(block_size)
+        elapsed_time, counter_updates, solution_ids, unapplied_count = (
+            run_benchmark(block_size))
+        assert len(set(solution_ids)) == total_solutions, 'Duplicated IDs!'
+        print '%-12d %12.3f %16d %12.0f %16d' % (
+            block_size, elapsed_time, counter_updates,
+            total_solutions / elapsed_time, unapplied_count)
+
+    client.drop_database(FLAGS.mongodb_db)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
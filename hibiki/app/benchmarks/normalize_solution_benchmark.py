@@ -0,0 +1,152 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares game.normalize_solution() with the previous implementation.
+
+Usage:
+    PYTHONPATH=. python benchmarks/normalize_solution_benchmark.py
+"""
+
+import sys
+import timeit
+
+from hibiki import game
+from hibiki import misc_util
+
+
+def legacy_normalize_solution(solution_spec):
+    """The list-popping implementation replaced in game.py, kept as baseline."""
+    new_solution_spec = ''
+    tokens = solution_spec.split()
+
+    try:
+        num_points = int(tokens.pop(0))
+    except Exception:
+        raise game.VerificationError('Parse error in the number of source vertices.')
+    if num_points <= 0:
+        raise game.VerificationError('Number of source vertices must be positive.')
+    new_solution_spec += '%d\n' % num_points
+
+    for i in xrange(num_points):
+        try:
+            point = tokens.pop(0)
+        except Exception:
+            raise game.VerificationError('Parse error in coordinate of source vertex #%d.' % i)
+        if not game._POINT_RE.search(point):
+            raise game.VerificationError('Parse error in coordinate of source vertex #%d.' % i)
+        new_solution_spec += '%s\n' % point
+
+    try:
+        num_facets = int(tokens.pop(0))
+    except Exception:
+        raise game.VerificationError('Parse error in the number of facets.')
+    if num_facets <= 0:
+        raise game.VerificationError('Number of facets must be positive.')
+    new_solution_spec += '%d\n' % num_facets
+
+    for i in xrange(num_facets):
+        try:
+            facet_size = int(tokens.pop(0))
+        except Exception:
+            raise game.VerificationError('Parse error in the size of facet #%d.' % i)
+        if facet_size < 3:
+            raise game.VerificationError('The size of facet #%d must be no less than three.' % i)
+
+        facet_def = []
+        for j in xrange(facet_size):
+            try:
+                point_index = int(tokens.pop(0))
+            except Exception:
+                raise game.VerificationError('A vertex index in facet #%d is invalid.' % i)
+            if not 0 <= point_index < num_points:
+                raise game.VerificationError('A vertex index in facet #%d is out of range.' % i)
+            facet_def.append(point_index)
+
+        if len(set(facet_def)) != facet_size:
+            raise game.VerificationError('Facet #%d has duplicated vertices.' % i)
+
+        new_solution_spec += '%d %s\n' % (
+            facet_size,
+            ' '.join('%d' % facet_index for facet_index in facet_def))
+
+    for i in xrange(num_points):
+        try:
+            point = tokens.pop(0)
+        except Exception:
+            raise game.VerificationError('Parse error in coordinate of destination vertex #%d.' % i)
+        if not game._POINT_RE.search(point):
+            raise game.VerificationError('Parse error in coordinate of destination vertex #%d.' % i)
+        new_solution_spec += '%s\n' % point
+
+    if tokens:
+        raise game.VerificationError('Redundant tokens found after the end of the specification.')
+
+    solution_size = sum(len(s) for s in new_solution_spec.split())
+    if solution_size > game._MAX_SOLUTION_SIZE:
+        raise game.VerificationError('Solution size limit exceeded.')
+
+    return (new_solution_spec, solution_size)
+
+
+def make_synthetic_spec(num_points):
+    """Makes a syntactically valid spec with |num_points| vertices.
+
+    Facets are triangles fanning out from vertex 0.
+    """
+    points = ['%d/%d,%d/%d' % (i % 7, 7, i % 5, 5) for i in xrange(num_points)]
+    facets = ['3 0 %d %d' % (i, i + 1) for i in xrange(1, num_points - 1)]
+    return '\n'.join(
+        ['%d' % num_points] + points + ['%d' % len(facets)] + facets + points)
+
+
+def make_max_size_spec():
+    """Makes the largest synthetic spec within the solution size limit."""
+    num_points = 3
+    while True:
+        try:
+            game.normalize_solution(make_synthetic_spec(num_points + 1))
+        except game.VerificationError:
+            return make_synthetic_spec(num_points)
+        num_points += 1
+
+
+def normalize_or_reject(normalize, solution_spec):
+    try:
+        normalize(solution_spec)
+    except game.VerificationError:
+        pass
+
+
+def main():
+    cases = [
+        ('testdata/lambda.txt', misc_util.load_testdata('lambda.txt'), 1000),
+        ('synthetic maximum-size', make_max_size_spec(), 1000),
+        ('synthetic 256KB oversized', make_synthetic_spec(8000), 10),
+    ]
+    print '%-28s %8s %14s %14s %8s' % (
+        'case', 'bytes', 'legacy (ms)', 'current (ms)', 'speedup')
+    for name, solution_spec, number in cases:
+        timings = []
+        for normalize in (legacy_normalize_solution, game.normalize_solution):
+            seconds = min(timeit.repeat(
+                lambda: normalize_or_reject(normalize, solution_spec),
+                number=number, repeat=3))
+            timings.append(seconds / number * 1000)
+        print '%-28s %8d %14.3f %14.3f %7.1fx' % (
+            name, len(solution_spec), timings[0], timings[1],
+            timings[0] / timings[1])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
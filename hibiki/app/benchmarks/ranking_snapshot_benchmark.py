@@ -0,0 +1,199 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares ranking snapshot builders on a synthetic dataset.
+
+The per-problem loop, which is the default, is compared with the aggregation
+builder and with the loop sharded among --snapshot_workers threads.
+
+This populates a scratch database on a running MongoDB server, so never
+point it to a production database.
+
+Usage:
+    PYTHONPATH=. python benchmarks/ranking_snapshot_benchmark.py \
+        --mongodb_url=mongodb://localhost
+"""
+
+import random
+import sys
+import time
+
+import gflags
+
+from hibiki import model
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string(
+    'benchmark_mongodb_db', 'hibiki_ranking_snapshot_benchmark',
+    'Scratch MongoDB database name. It is dropped on start.')
+gflags.DEFINE_integer(
+    'benchmark_problems', 5000,
+    'Number of synthetic problems.')
+gflags.DEFINE_integer(
+    'benchmark_teams', 300,
+    'Number of synthetic teams.')
+gflags.DEFINE_float(
+    'benchmark_solve_ratio', 0.2,
+    'Probability that a team submits to a problem in a snapshot interval.')
+gflags.DEFINE_float(
+    'benchmark_dirty_ratio', 0.1,
+    'Ratio of problems receiving solutions in the second interval.')
+gflags.DEFINE_integer(
+    'benchmark_snapshot_workers', 4,
+    'Value of --snapshot_workers for the sharded loop.')
+
+# Settings required by hibiki.settings, chosen to make a valid contest.
+_DEFAULT_ARGS = [
+    '--contest_start_time=0',
+    '--contest_first_publish_time=0',
+    '--contest_freeze_time=86400',
+    '--contest_last_publish_time=86400',
+    '--contest_end_time=86400',
+    '--contest_primary_snapshot_interval=3600',
+    '--contest_secondary_snapshot_interval=600',
+    '--api_rate_limit_window_size=3600',
+    '--api_rate_limit_submissions_in_window=1000',
+    '--api_rate_limit_blob_lookups_in_window=1000',
+    '--admin_password=benchmark',
+]
+
+_BATCH_SIZE = 10000
+
+
+def insert_solutions(problem_ids, start_time, end_time, next_solution_id):
+    """Inserts random solutions created in [start_time, end_time).
+
+    Returns:
+        The next solution ID.
+    """
+    batch = []
+    for problem_id in problem_ids:
+        for team in xrange(FLAGS.benchmark_teams):
+            if random.random() >= FLAGS.benchmark_solve_ratio:
+                continue
+            batch.append({
+                '_id': next_solution_id,
+                'create_time': random.randrange(start_time, end_time),
+                'owner': 't%d' % team,
+                'problem_id': problem_id,
+                'problem_spec_hash': 'p%d' % problem_id,
+                'solution_spec_hash': 's%d' % next_solution_id,
+                'solution_size': random.randint(100, 5000),
+                'resemblance_int': random.choice(
+                    [1000000, random.randint(0, 999999)]),
+                'processing_time': 0.1,
+            })
+            next_solution_id += 1
+            if len(batch) >= _BATCH_SIZE:
+                model._db.solutions.insert_many(batch)
+                batch = []
+    if batch:
+        model._db.solutions.insert_many(batch)
+    return next_solution_id
+
+
+def populate():
+    """Populates the scratch database.
+
+    Returns:
+        A list of problem IDs receiving solutions in the second interval.
+    """
+    interval = FLAGS.contest_secondary_snapshot_interval
+    problem_ids = range(1, FLAGS.benchmark_problems + 1)
+    problems = [
+        {
+            '_id': problem_id,
+            'create_time': 0,
+            'owner': 't%d' % (problem_id % FLAGS.benchmark_teams),
+            'problem_spec_hash': 'p%d' % problem_id,
+            'problem_size': 1000,
+            'solution_spec_hash': 's0',
+            'solution_size': 1000,
+            'public': True,
+            'publish_time': 0,
+            'processing_time': 0.1,
+            'last_solution_time': interval - 1,
+        }
+        for problem_id in problem_ids
+    ]
+    model._db.problems.insert_many(problems)
+    next_solution_id = insert_solutions(problem_ids, 0, interval, 1)
+    dirty_problem_ids = random.sample(
+        problem_ids, int(len(problem_ids) * FLAGS.benchmark_dirty_ratio))
+    insert_solutions(dirty_problem_ids, interval, interval * 2, next_solution_id)
+    model._db.problems.update_many(
+        {'_id': {'$in': dirty_problem_ids}},
+        {'$set': {'last_solution_time': interval * 2 - 1}})
+    return dirty_problem_ids
+
+
+def run_builder(builder, num_workers):
+    """Builds snapshots of the first two intervals with a builder.
+
+    Returns:
+        (timings, rankings)
+    """
+    interval = FLAGS.contest_secondary_snapshot_interval
+    FLAGS.ranking_snapshot_builder = builder
+    FLAGS.snapshot_workers = num_workers
+    model._db.problem_ranking_snapshots.delete_many({})
+    timings = []
+    for snapshot_time in (interval, interval * 2):
+        start_time = time.time()
+        model.update_problem_ranking_snapshots(snapshot_time)
+        timings.append(time.time() - start_time)
+    cursor = model._db.problem_ranking_snapshots.find(
+        {'snapshot_time': interval * 2})
+    rankings = {
+        snapshot['problem_id']: snapshot['ranking']
+        for snapshot in model._iter_resolved_problem_ranking_snapshots(cursor)
+    }
+    return (timings, rankings)
+
+
+def main(argv):
+    FLAGS(argv[:1] + _DEFAULT_ARGS + argv[1:])
+    FLAGS.mongodb_db = FLAGS.benchmark_mongodb_db
+    random.seed(0)
+    model.connect()
+    model._client.drop_database(FLAGS.mongodb_db)
+    model._init_model()
+
+    dirty_problem_ids = populate()
+    print '%d problems, %d teams, %d solutions, %d dirty problems' % (
+        FLAGS.benchmark_problems, FLAGS.benchmark_teams,
+        model._db.solutions.count(), len(dirty_problem_ids))
+
+    configs = [
+        ('loop', 1),
+        ('aggregation', 1),
+        ('loop', FLAGS.benchmark_snapshot_workers),
+    ]
+    results = []
+    print '%-12s %8s %18s %18s' % (
+        'builder', 'workers', 'all dirty (s)', 'some dirty (s)')
+    for builder, num_workers in configs:
+        timings, rankings = run_builder(builder, num_workers)
+        results.append(rankings)
+        print '%-12s %8d %18.3f %18.3f' % (
+            builder, num_workers, timings[0], timings[1])
+    assert all(rankings == results[0] for rankings in results), (
+        'Rankings differ!')
+
+    model._client.drop_database(FLAGS.mongodb_db)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
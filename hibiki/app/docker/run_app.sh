@@ -37,6 +37,8 @@ uwsgi \
   --workers=$(( $(nproc) * 2 )) \
   --threads=64 \
   --master-fifo=/tmp/uwsgi-fifo \
+  --cache2=name=rate_limits,items=100000,blocksize=128 \
+  --locks=64 \
   "$@" &
 
 while :; do
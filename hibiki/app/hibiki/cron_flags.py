@@ -19,3 +19,11 @@ import gflags
 gflags.DEFINE_bool(
     'remove_stale_snapshots_demo_only', False,
     'Removes stale snapshots.')
+gflags.DEFINE_integer(
+    'secondary_snapshot_retention', 0,
+    'If positive, non-public snapshots older than this many seconds before '
+    'the last snapshot are removed. Public snapshots are always kept.')
+gflags.DEFINE_integer(
+    'count_reconciliation_interval', 3600,
+    'Interval in seconds of correcting cached document counts by counting '
+    'collections. If zero, they are never corrected.')
@@ -44,8 +44,23 @@ def snapshot_job():
         secondary_snapshot_time = settings.get_last_secondary_snapshot_time()
         if model.lock_snapshot_cron_job(secondary_snapshot_time):
             _make_snapshot(secondary_snapshot_time)
+            if FLAGS.secondary_snapshot_retention > 0:
+                # Snapshots of the last interval are needed to compute the
+                # next ones incrementally.
+                retention = max(
+                    FLAGS.secondary_snapshot_retention,
+                    FLAGS.contest_secondary_snapshot_interval * 2)
+                model.remove_secondary_snapshots(
+                    secondary_snapshot_time - retention)
         if FLAGS.remove_stale_snapshots_demo_only:
             model.remove_stale_snapshots_for_demo(
                 primary_snapshot_time - FLAGS.contest_primary_snapshot_interval * 100)
     except Exception:
         eventlog.exception('cron job failure')
+
+
+def reconcile_counts_job():
+    try:
+        model.reconcile_counts()
+    except Exception:
+        eventlog.exception('cron job failure')
@@ -51,6 +51,11 @@ def main():
         start_date=datetime.datetime.fromtimestamp(
             settings.get_last_secondary_snapshot_time() + 5),
         end_date=datetime.datetime.fromtimestamp(FLAGS.contest_end_time + 6))
+    if FLAGS.count_reconciliation_interval > 0:
+        sched.add_job(
+            cron_jobs.reconcile_counts_job,
+            'interval',
+            seconds=FLAGS.count_reconciliation_interval)
     sched.start()
 
     # We need to set some timeout to allow signal handler interruption.
@@ -14,6 +14,8 @@
 
 import contextlib
 import logging
+import threading
+import time
 import traceback
 
 import fluent.event
@@ -27,6 +29,14 @@ FLAGS = gflags.FLAGS
 gflags.DEFINE_bool(
     'enable_eventlog', False,
     'Enable eventlog reporting.')
+gflags.DEFINE_integer(
+    'eventlog_stats_interval', 60,
+    'Minimum interval in seconds between periodic statistics events, such as '
+    'cache statistics.')
+
+# Last times when periodic events were emitted, keyed by event names.
+_last_periodic_emit_times = {}
+_last_periodic_emit_times_lock = threading.Lock()
 
 
 def connect():
@@ -49,6 +59,28 @@ def emit(name, data):
     fluent.event.Event(name, data)
 
 
+def emit_periodically(name, get_data):
+    """Emits an event log at most once in --eventlog_stats_interval seconds.
+
+    This is cheap enough to be called on hot paths, as |get_data| is called
+    only when the event is emitted.
+
+    Args:
+        name: Name of the event.
+        get_data: A function returning the dictionary of the event data.
+    """
+    if not FLAGS.enable_eventlog:
+        return
+    now = time.time()
+    with _last_periodic_emit_times_lock:
+        last_emit_time = _last_periodic_emit_times.get(name)
+        if (last_emit_time is not None and
+                now - last_emit_time < FLAGS.eventlog_stats_interval):
+            return
+        _last_periodic_emit_times[name] = now
+    emit(name, get_data())
+
+
 def exception(msg, *args):
     if args:
         msg = msg % args
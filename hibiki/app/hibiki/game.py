@@ -12,18 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import re
+import select
+import sys
 import tempfile
+import threading
+import time as time_lib
 
 import gflags
 import subprocess32 as subprocess
 
 FLAGS = gflags.FLAGS
 
+gflags.DEFINE_integer(
+    'judge_worker_pool_size', 0,
+    'Number of persistent akatsuki worker processes per app process. '
+    'If zero, a new akatsuki process is started for every judge request.')
+
 _MAX_SOLUTION_SIZE = 5000
 
 _JUDGE_TIMEOUT_SECONDS = 30
 
+_TOKENIZER_CHUNK_SIZE = 64 * 1024
+
+_AKATSUKI_PATH = './akatsuki'
+
 _NUMBER_RE = re.compile(
     r'^'
     r'(0|-?[1-9][0-9]*|((0|-?[1-9][0-9]*)/[1-9][0-9]*))'
@@ -53,6 +67,278 @@ def make_temporary_file_with_content(content):
     return f
 
 
+class _JudgeWorkerDiedError(AssertionError):
+    pass
+
+
+class _JudgeWorkerUnavailableError(_JudgeWorkerDiedError):
+    """Raised if a worker died before it received a request."""
+
+
+class _JudgeWorker(object):
+    """A persistent akatsuki process running in the server mode."""
+
+    def __init__(self):
+        with open(os.devnull, 'w') as devnull:
+            self._proc = subprocess.Popen(
+                [_AKATSUKI_PATH, '--logtostderr', '--server'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull)
+        self._buffer = ''
+
+    def is_alive(self):
+        return self._proc.poll() is None
+
+    def kill(self):
+        if self.is_alive():
+            self._proc.kill()
+        self._proc.wait()
+
+    def call(self, command, payloads, timeout):
+        """Sends a request to the worker and waits for its response.
+
+        Args:
+            command: Request command name.
+            payloads: List of payload strings.
+            timeout: Timeout in seconds.
+
+        Returns:
+            (ok, output)
+            ok: False if the request was rejected as an invalid solution.
+            output: Output of the corresponding one-shot mode.
+
+        Raises:
+            subprocess.TimeoutExpired: On judge timeout.
+            _JudgeWorkerUnavailableError: If the worker had died before the
+                request was sent.
+            _JudgeWorkerDiedError: If the worker died while processing the
+                request.
+        """
+        deadline = time_lib.time() + timeout
+        payloads = [
+            payload.encode('ascii') if isinstance(payload, unicode) else payload
+            for payload in payloads]
+        header = ' '.join([command] + ['%d' % len(payload) for payload in payloads])
+        try:
+            self._proc.stdin.write(header + '\n' + ''.join(payloads))
+            self._proc.stdin.flush()
+        except IOError:
+            raise _JudgeWorkerUnavailableError('akatsuki worker died')
+        while '\n' not in self._buffer:
+            self._fill_buffer(deadline, timeout)
+        status_line, self._buffer = self._buffer.split('\n', 1)
+        status, length = status_line.split()
+        length = int(length)
+        while len(self._buffer) < length:
+            self._fill_buffer(deadline, timeout)
+        output, self._buffer = self._buffer[:length], self._buffer[length:]
+        return (status == 'ok', output)
+
+    def _fill_buffer(self, deadline, timeout):
+        fd = self._proc.stdout.fileno()
+        remaining = deadline - time_lib.time()
+        readable = remaining > 0 and select.select([fd], [], [], remaining)[0]
+        if not readable:
+            raise subprocess.TimeoutExpired(_AKATSUKI_PATH, timeout)
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            raise _JudgeWorkerDiedError('akatsuki worker died')
+        self._buffer += chunk
+
+
+class _JudgeWorkerPool(object):
+    """A bounded pool of persistent akatsuki workers.
+
+    Workers are started on demand. A worker is discarded when it crashes or
+    times out, and a fresh one is started for the next request. Invalid specs
+    are answered with errors by workers, so a crash while processing a
+    request is reported without retrying it.
+    """
+
+    def __init__(self, size):
+        self.pid = os.getpid()
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle_workers = []
+
+    def call(self, command, payloads):
+        """Runs a request on a pooled worker. See _JudgeWorker.call()."""
+        with self._semaphore:
+            worker, reused = self._checkout()
+            try:
+                try:
+                    result = worker.call(command, payloads, _JUDGE_TIMEOUT_SECONDS)
+                except _JudgeWorkerUnavailableError:
+                    if not reused:
+                        raise  # report ISE
+                    # The idle worker may have died silently. Retry once.
+                    worker.kill()
+                    worker = self._start_worker()
+                    result = worker.call(command, payloads, _JUDGE_TIMEOUT_SECONDS)
+            except:
+                worker.kill()
+                raise
+            with self._lock:
+                self._idle_workers.append(worker)
+            return result
+
+    def _checkout(self):
+        with self._lock:
+            while self._idle_workers:
+                worker = self._idle_workers.pop()
+                if worker.is_alive():
+                    return (worker, True)
+                worker.kill()
+        return (self._start_worker(), False)
+
+    def _start_worker(self):
+        worker = _JudgeWorker()
+        # Health check the new worker before using it.
+        try:
+            ok, _ = worker.call('ping', [], _JUDGE_TIMEOUT_SECONDS)
+            assert ok, 'akatsuki worker failed to respond to ping'
+        except:
+            worker.kill()
+            raise
+        return worker
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def _get_worker_pool():
+    global _worker_pool
+    with _worker_pool_lock:
+        # uWSGI may fork after import, so do not share a pool across processes.
+        if _worker_pool is None or _worker_pool.pid != os.getpid():
+            _worker_pool = _JudgeWorkerPool(FLAGS.judge_worker_pool_size)
+        return _worker_pool
+
+
+def _run_judge_once(mode, specs):
+    files = [make_temporary_file_with_content(spec) for spec in specs]
+    try:
+        proc = subprocess.Popen(
+            [_AKATSUKI_PATH, '--logtostderr', '--%s' % mode] +
+            [f.name for f in files],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        try:
+            stdout_output, stderr_output = proc.communicate(
+                timeout=_JUDGE_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise  # report ISE
+    finally:
+        for f in files:
+            f.close()
+    return (proc.returncode == 0, stdout_output)
+
+
+class _InFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class _SingleFlight(object):
+    """Coalesces concurrent calls with the same key into a single call.
+
+    Callers arriving while a call with the same key is in progress wait for
+    it and share its return value or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlightCall()
+        if not leader:
+            call.done.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+        try:
+            call.result = func(*args)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+_single_flight = _SingleFlight()
+
+
+def _run_judge_uncoalesced(mode, specs):
+    if FLAGS.judge_worker_pool_size > 0:
+        return _get_worker_pool().call(mode, specs)
+    return _run_judge_once(mode, specs)
+
+
+def _run_judge(mode, specs):
+    """Runs akatsuki.
+
+    Identical requests running concurrently in this process share one run.
+
+    Args:
+        mode: 'compile' or 'evaluate'.
+        specs: List of specification strings passed to akatsuki.
+
+    Returns:
+        (ok, stdout_output)
+
+    Raises:
+        subprocess.TimeoutExpired: On judge timeout.
+        AssertionError: If akatsuki crashed.
+    """
+    key = (mode,) + tuple(specs)
+    return _single_flight.call(key, _run_judge_uncoalesced, mode, specs)
+
+
+def _iter_tokens(solution_spec):
+    """Yields whitespace-separated tokens in the same way as split().
+
+    The spec is split one chunk at a time so that callers can stop early
+    without tokenizing the whole spec.
+    """
+    partial = []  # Pieces of a token spanning chunk boundaries.
+    for start in xrange(0, len(solution_spec), _TOKENIZER_CHUNK_SIZE):
+        chunk = solution_spec[start:start + _TOKENIZER_CHUNK_SIZE]
+        if partial and chunk[0].isspace():
+            yield ''.join(partial)
+            partial = []
+        tokens = chunk.split()
+        if not tokens:
+            continue
+        ends_in_token = not chunk[-1].isspace()
+        if partial:
+            partial.append(tokens[0])
+            if len(tokens) == 1 and ends_in_token:
+                continue
+            yield ''.join(partial)
+            partial = []
+            tokens = tokens[1:]
+        if ends_in_token:
+            partial.append(tokens.pop())
+        for token in tokens:
+            yield token
+    if partial:
+        yield ''.join(partial)
+
+
 def normalize_solution(solution_spec):
     """Normalizes a solution spec.
 
@@ -67,76 +353,95 @@ def normalize_solution(solution_spec):
     Raises:
         VerificationError: When parsing failed.
     """
-    new_solution_spec = ''
-    tokens = solution_spec.split()
+    next_token = _iter_tokens(solution_spec).next
+    lines = []
+    # The solution size is accumulated as we go so that oversized specs are
+    # rejected without reading the rest of them.
+    solution_size = 0
 
     try:
-        num_points = int(tokens.pop(0))
+        num_points = int(next_token())
     except Exception:
         raise VerificationError('Parse error in the number of source vertices.')
     if num_points <= 0:
         raise VerificationError('Number of source vertices must be positive.')
-    new_solution_spec += '%d\n' % num_points
+    line = '%d' % num_points
+    lines.append(line)
+    solution_size += len(line)
 
     for i in xrange(num_points):
         try:
-            point = tokens.pop(0)
-        except Exception:
+            point = next_token()
+        except StopIteration:
             raise VerificationError('Parse error in coordinate of source vertex #%d.' % i)
         if not _POINT_RE.search(point):
             raise VerificationError('Parse error in coordinate of source vertex #%d.' % i)
-        new_solution_spec += '%s\n' % point
+        lines.append(point)
+        solution_size += len(point)
+        if solution_size > _MAX_SOLUTION_SIZE:
+            raise VerificationError('Solution size limit exceeded.')
 
     try:
-        num_facets = int(tokens.pop(0))
+        num_facets = int(next_token())
     except Exception:
         raise VerificationError('Parse error in the number of facets.')
     if num_facets <= 0:
         raise VerificationError('Number of facets must be positive.')
-    new_solution_spec += '%d\n' % num_facets
+    line = '%d' % num_facets
+    lines.append(line)
+    solution_size += len(line)
 
     for i in xrange(num_facets):
         try:
-            facet_size = int(tokens.pop(0))
+            facet_size = int(next_token())
         except Exception:
             raise VerificationError('Parse error in the size of facet #%d.' % i)
         if facet_size < 3:
             raise VerificationError('The size of facet #%d must be no less than three.' % i)
 
-        facet_def = []
+        facet_tokens = ['%d' % facet_size]
+        solution_size += len(facet_tokens[0])
+        facet_def = set()
         for j in xrange(facet_size):
             try:
-                point_index = int(tokens.pop(0))
+                point_index = int(next_token())
             except Exception:
                 raise VerificationError('A vertex index in facet #%d is invalid.' % i)
             if not 0 <= point_index < num_points:
                 raise VerificationError('A vertex index in facet #%d is out of range.' % i)
-            facet_def.append(point_index)
-
-        if len(set(facet_def)) != facet_size:
+            facet_def.add(point_index)
+            token = '%d' % point_index
+            facet_tokens.append(token)
+            solution_size += len(token)
+            if solution_size > _MAX_SOLUTION_SIZE:
+                raise VerificationError('Solution size limit exceeded.')
+
+        if len(facet_def) != facet_size:
             raise VerificationError('Facet #%d has duplicated vertices.' % i)
 
-        new_solution_spec += '%d %s\n' % (
-            facet_size,
-            ' '.join('%d' % facet_index for facet_index in facet_def))
+        lines.append(' '.join(facet_tokens))
 
     for i in xrange(num_points):
         try:
-            point = tokens.pop(0)
-        except Exception:
+            point = next_token()
+        except StopIteration:
             raise VerificationError('Parse error in coordinate of destination vertex #%d.' % i)
         if not _POINT_RE.search(point):
             raise VerificationError('Parse error in coordinate of destination vertex #%d.' % i)
-        new_solution_spec += '%s\n' % point
+        lines.append(point)
+        solution_size += len(point)
+        if solution_size > _MAX_SOLUTION_SIZE:
+            raise VerificationError('Solution size limit exceeded.')
 
-    if tokens:
+    try:
+        next_token()
+    except StopIteration:
+        pass
+    else:
         raise VerificationError('Redundant tokens found after the end of the specification.')
 
-    solution_size = sum(len(s) for s in new_solution_spec.split())
-    if solution_size > _MAX_SOLUTION_SIZE:
-        raise VerificationError('Solution size limit exceeded.')
-
-    return (new_solution_spec, solution_size)
+    lines.append('')
+    return ('\n'.join(lines), solution_size)
 
 
 def compile_problem(solution_spec):
@@ -156,19 +461,8 @@ def compile_problem(solution_spec):
         subprocess.TimeoutExpired: On judge timeout.
         AssertionError: On scrape error.
     """
-    with make_temporary_file_with_content(solution_spec) as solution_file:
-        proc = subprocess.Popen(
-            ['./akatsuki', '--logtostderr', '--compile', solution_file.name],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        try:
-            stdout_output, stderr_output = proc.communicate(
-                timeout=_JUDGE_TIMEOUT_SECONDS)
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            proc.wait()
-            raise  # report ISE
-    if proc.returncode:
+    ok, stdout_output = _run_judge('compile', [solution_spec])
+    if not ok:
         m = _VERIFICATION_ERROR_RE.search(stdout_output)
         assert m, stdout_output  # report ISE
         raise VerificationError(m.group(1))
@@ -192,21 +486,8 @@ def evaluate_solution(problem_spec, solution_spec):
         subprocess.TimeoutExpired: On judge timeout.
         AssertionError: On scrape error.
     """
-    with make_temporary_file_with_content(problem_spec) as problem_file, \
-         make_temporary_file_with_content(solution_spec) as solution_file:
-        proc = subprocess.Popen(
-            ['./akatsuki', '--logtostderr', '--evaluate',
-             problem_file.name, solution_file.name],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        try:
-            stdout_output, stderr_output = proc.communicate(
-                timeout=_JUDGE_TIMEOUT_SECONDS)
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            proc.wait()
-            raise  # report ISE
-    if proc.returncode:
+    ok, stdout_output = _run_judge('evaluate', [problem_spec, solution_spec])
+    if not ok:
         m = _VERIFICATION_ERROR_RE.search(stdout_output)
         assert m, stdout_output  # report ISE
         raise VerificationError(m.group(1))
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
 import logging
 import os
@@ -26,6 +27,7 @@ from hibiki import cron_jobs
 from hibiki import eventlog
 from hibiki import game
 from hibiki import handler_util
+from hibiki import judge
 from hibiki import misc_util
 from hibiki import model
 from hibiki import settings
@@ -218,18 +220,12 @@ def profile_post_handler():
 @bottle.get('/problem/list')
 @handler_util.require_login
 def problem_list_handler():
-    try:
-        page = int(bottle.request.query.get('page', 1))
-    except ValueError:
-        page = 1
-    count = model.count_public_problems()
-    problems = model.get_public_problems(
-        limit=FLAGS.pagination_items_per_page,
-        skip=(page - 1) * FLAGS.pagination_items_per_page)
+    problems, pagination = handler_util.paginate(
+        model.get_public_problems,
+        FLAGS.pagination_items_per_page,
+        model.count_public_problems())
     team_display_name_map = handler_util.compute_team_display_name_map(
         problem['owner'] for problem in problems)
-    pagination = handler_util.Pagination(
-        page, FLAGS.pagination_items_per_page, count)
     template_dict = {
         'problems': problems,
         'team_display_name_map': team_display_name_map,
@@ -364,12 +360,10 @@ def solution_submit_post_handler():
     if username == problem['owner']:
         bottle.abort(403, 'Can not submit a solution to an own problem.')
     problem_spec_hash = problem['problem_spec_hash']
-    problem_spec = model.load_blob(problem_spec_hash)
     try:
-        with eventlog.record_time('judge') as record:
-            solution_spec, solution_size = game.normalize_solution(solution_spec)
-            resemblance_int, raw_evaluator_output = game.evaluate_solution(
-                problem_spec, solution_spec)
+        solution_spec, solution_size = game.normalize_solution(solution_spec)
+        resemblance_int, processing_time = judge.evaluate_solution(
+            problem_spec_hash, solution_spec)
     except game.VerificationError as e:
         bottle.abort(400, 'Invalid solution spec: %s' % e.message)
     new_solution = model.register_solution(
@@ -379,7 +373,7 @@ def solution_submit_post_handler():
         solution_spec=solution_spec,
         solution_size=solution_size,
         resemblance_int=resemblance_int,
-        processing_time=record['processing_time'])
+        processing_time=processing_time)
     template_dict = {
         'solution': new_solution,
         'solution_spec': solution_spec,
@@ -389,19 +383,41 @@ def solution_submit_post_handler():
 
 @bottle.get('/leaderboard')
 def leaderboard_handler():
-    snapshot_time, ranking = model.get_last_leaderboard_snapshot(public_only=True)
-    team_display_name_map = handler_util.compute_team_display_name_map(
-        entry['username'] for entry in ranking)
-
     sushify_mode = get_sushify_mode()
-    for entry in ranking:
-        entry["score"] = sushify(sushify_mode, '%.1f' % entry["score"])
-
+    # The ranking is copied only when the fragment below is rendered.
+    snapshot_time, ranking = model.get_last_leaderboard_snapshot(
+        public_only=True, copy=False)
+    # The page depends on the current user as well as the snapshot.
+    page_key = '%d:%s:%s:%s:%s' % (
+        snapshot_time,
+        handler_util.get_current_username(),
+        handler_util.get_xsrf_token(),
+        handler_util.is_admin(),
+        sushify_mode)
+    handler_util.check_not_modified(
+        'leaderboard-%s' % hashlib.sha1(page_key).hexdigest())
+
+    def compute_body_template_dict():
+        team_display_name_map = handler_util.compute_team_display_name_map(
+            (entry['username'] for entry in ranking),
+            cache_key=('leaderboard', snapshot_time))
+        sushified_ranking = [
+            dict(entry, score=sushify(sushify_mode, '%.1f' % entry['score']))
+            for entry in ranking]
+        return {
+            'snapshot_time': snapshot_time,
+            'ranking': sushified_ranking,
+            'team_display_name_map': team_display_name_map,
+            'sushify_mode': sushify_mode,
+        }
+
+    # The ranking table is the same for all users, so it is rendered once per
+    # snapshot and embedded into the per-user page.
+    leaderboard_body = handler_util.render_fragment(
+        ('leaderboard', snapshot_time, sushify_mode),
+        'bits/leaderboard_body.html', compute_body_template_dict)
     template_dict = {
-        'snapshot_time': snapshot_time,
-        'ranking': ranking,
-        'team_display_name_map': team_display_name_map,
-        'sushify_mode': sushify_mode,
+        'leaderboard_body': leaderboard_body,
     }
     return handler_util.render('leaderboard.html', template_dict)
 
@@ -435,6 +451,10 @@ def api_snapshot_list_handler():
     handler_util.enforce_api_rate_limit(
         action='snapshot_list',
         limit_in_window=1000)
+    last_snapshot_time = model.get_last_public_contest_snapshot_time()
+    if last_snapshot_time is not None:
+        handler_util.check_not_modified(
+            'snapshots-%d' % last_snapshot_time, last_modified=last_snapshot_time)
     contest_snapshots = model.get_public_contest_snapshots()
     response = {
         'snapshots': [
@@ -448,6 +468,29 @@ def api_snapshot_list_handler():
     return response
 
 
+def _normalize_submitted_solution_spec(solution_spec):
+    """Normalizes a solution spec submitted to the API, or responds 400."""
+    try:
+        return game.normalize_solution(solution_spec)
+    except game.VerificationError as e:
+        bottle.abort(400, 'Invalid solution spec: %s' % e.message)
+
+
+def _should_judge_async():
+    if FLAGS.async_judge == 'optional':
+        return bottle.request.forms.get('async') == '1'
+    return FLAGS.async_judge == 'always'
+
+
+def _enqueue_judge_job(kind, params):
+    """Queues an API submission to be judged by judge_runner_main."""
+    new_job = model.enqueue_judge_job(
+        kind=kind,
+        owner=handler_util.get_current_username(),
+        params=params)
+    return {'job_id': new_job['_id'], 'status': new_job['status']}
+
+
 @bottle.post('/api/problem/submit')
 @handler_util.json_api_handler
 def api_problem_submit_handler():
@@ -482,34 +525,23 @@ def api_problem_submit_handler():
             bottle.abort(403, 'Invalid publish time.')
         if publish_time < misc_util.time():
             bottle.abort(403, 'Missed the publish time.')
+    solution_spec, solution_size = _normalize_submitted_solution_spec(
+        solution_spec)
+    params = {
+        'solution_spec': solution_spec,
+        'solution_size': solution_size,
+        'publish_time': publish_time,
+        'organizer': organizer,
+    }
+    if _should_judge_async():
+        return _enqueue_judge_job('problem', params)
     try:
-        with eventlog.record_time('judge') as record:
-            solution_spec, solution_size = game.normalize_solution(solution_spec)
-            problem_spec, problem_size = game.compile_problem(solution_spec)
+        return judge.judge_problem_submission(
+            handler_util.get_current_username(), params)
     except game.VerificationError as e:
         bottle.abort(400, 'Invalid solution spec: %s' % e.message)
-    create_time = misc_util.time()
-    if not organizer and publish_time < create_time:
-        bottle.abort(403, 'Missed the publish time.')
-    new_problem = model.enqueue_problem(
-        owner=handler_util.get_current_username(),
-        problem_spec=problem_spec,
-        problem_size=problem_size,
-        solution_spec=solution_spec,
-        solution_size=solution_size,
-        create_time=create_time,
-        publish_time=publish_time,
-        processing_time=record['processing_time'],
-        publish_immediately=organizer)
-    response = {
-        'problem_id': new_problem['_id'],
-        'publish_time': new_problem['publish_time'],
-        'problem_spec_hash': new_problem['problem_spec_hash'],
-        'problem_size': new_problem['problem_size'],
-        'solution_spec_hash': new_problem['solution_spec_hash'],
-        'solution_size': new_problem['solution_size'],
-    }
-    return response
+    except judge.SubmissionError as e:
+        bottle.abort(403, e.message)
 
 
 @bottle.post('/api/solution/submit')
@@ -542,33 +574,45 @@ def api_solution_submit_handler():
     if username == problem['owner']:
         bottle.abort(403, 'Can not submit a solution to an own problem.')
     problem_spec_hash = problem['problem_spec_hash']
-    problem_spec = model.load_blob(problem_spec_hash)
     if FLAGS.enable_load_test_hacks:
         if solution_spec.strip() == 'loadtest-trivial':
             solution_spec = misc_util.load_testdata('trivial.txt')
         elif solution_spec.strip() == 'loadtest-lambda':
             solution_spec = misc_util.load_testdata('lambda.txt')
+    solution_spec, solution_size = _normalize_submitted_solution_spec(
+        solution_spec)
+    params = {
+        'problem_id': problem_id,
+        'problem_spec_hash': problem_spec_hash,
+        'solution_spec': solution_spec,
+        'solution_size': solution_size,
+    }
+    if _should_judge_async():
+        return _enqueue_judge_job('solution', params)
     try:
-        with eventlog.record_time('judge') as record:
-            solution_spec, solution_size = game.normalize_solution(solution_spec)
-            resemblance_int, raw_evaluator_output = game.evaluate_solution(
-                problem_spec, solution_spec)
+        return judge.judge_solution_submission(username, params)
     except game.VerificationError as e:
         bottle.abort(400, 'Invalid solution spec: %s' % e.message)
-    new_solution = model.register_solution(
-        owner=username,
-        problem_id=problem_id,
-        problem_spec_hash=problem_spec_hash,
-        solution_spec=solution_spec,
-        solution_size=solution_size,
-        resemblance_int=resemblance_int,
-        processing_time=record['processing_time'])
+
+
+@bottle.get('/api/job/<job_id>')
+@handler_util.json_api_handler
+def api_job_handler(job_id):
+    handler_util.enforce_api_rate_limit(
+        action='job_lookup',
+        limit_in_window=1000)
+    try:
+        job = model.get_judge_job(job_id, owner=handler_util.get_current_username())
+    except KeyError:
+        bottle.abort(404, 'Job not found.')
     response = {
-        'problem_id': new_solution['problem_id'],
-        'solution_spec_hash': new_solution['solution_spec_hash'],
-        'solution_size': new_solution['solution_size'],
-        'resemblance': new_solution['resemblance_int'] / 1000000.0,
+        'job_id': job['_id'],
+        'status': job['status'],
     }
+    if job['status'] == 'done':
+        response['result'] = job['result']
+    elif job['status'] == 'failed':
+        response['error'] = job['error']
     return response
 
 
@@ -582,11 +626,25 @@ def api_blob_handler(hash):
     url = model.get_signed_blob_url(hash)
     if url:
         bottle.redirect(url)
+    # Blobs are stored gzip-compressed, so serve them as is if possible.
+    gzipped = handler_util.accepts_gzip()
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+    # Blobs are immutable as they are keyed by their content hashes, so a
+    # client holding the ETag has the blob and it need not be looked up.
+    # They are not cached by nginx as they require an API key.
+    handler_util.check_not_modified(
+        '%s-gzip' % hash if gzipped else hash,
+        cache_control='private, max-age=31536000, immutable')
     try:
-        blob = model.load_blob(hash)
+        if gzipped:
+            blob = model.load_gzipped_blob(hash)
+        else:
+            blob = model.load_blob(hash)
     except KeyError:
         bottle.abort(404, 'Blob not found')
     bottle.response.content_type = 'text/plain'
+    if gzipped:
+        bottle.response.set_header('Content-Encoding', 'gzip')
     return blob
 
 
@@ -657,15 +715,12 @@ def calculate_statistics_for_user(user, problems, solutions):
 @bottle.get('/admin/problem/list')
 @handler_util.require_admin
 def admin_problem_list_handler():
-    page = int(bottle.request.query.get('page', 1))
-    count = model.count_all_problems_for_admin()
-    problems = model.get_all_problems_for_admin(
-        limit=FLAGS.pagination_items_per_page,
-        skip=(page - 1) * FLAGS.pagination_items_per_page)
+    problems, pagination = handler_util.paginate(
+        model.get_all_problems_for_admin,
+        FLAGS.pagination_items_per_page,
+        model.count_all_problems_for_admin())
     team_display_name_map = handler_util.compute_team_display_name_map(
         problem['owner'] for problem in problems)
-    pagination = handler_util.Pagination(
-        page, FLAGS.pagination_items_per_page, count)
     template_dict = {
         'problems': problems,
         'team_display_name_map': team_display_name_map,
@@ -677,14 +732,12 @@ def admin_problem_list_handler():
 @bottle.get('/admin/problem/vislist')
 @handler_util.require_admin
 def admin_problem_vislist_handler():
-    page = int(bottle.request.query.get('page', 1))
-    count = model.count_all_problems_for_admin()
-    problems = model.get_all_problems_for_admin(
-        limit=30,
-        skip=(page - 1) * 30)
+    problems, pagination = handler_util.paginate(
+        model.get_all_problems_for_admin,
+        30,
+        model.count_all_problems_for_admin())
     team_display_name_map = handler_util.compute_team_display_name_map(
         problem['owner'] for problem in problems)
-    pagination = handler_util.Pagination(page, 30, count)
     template_dict = {
         'problems': problems,
         'team_display_name_map': team_display_name_map,
@@ -722,15 +775,12 @@ def admin_problem_view_handler(problem_id):
 @bottle.get('/admin/solution/list')
 @handler_util.require_admin
 def admin_solution_list_handler():
-    page = int(bottle.request.query.get('page', 1))
-    count = model.count_all_solutions_for_admin()
-    solutions = model.get_all_solutions_for_admin(
-        limit=FLAGS.pagination_items_per_page,
-        skip=(page - 1) * FLAGS.pagination_items_per_page)
+    solutions, pagination = handler_util.paginate(
+        model.get_all_solutions_for_admin,
+        FLAGS.pagination_items_per_page,
+        model.count_all_solutions_for_admin())
     team_display_name_map = handler_util.compute_team_display_name_map(
         solution['owner'] for solution in solutions)
-    pagination = handler_util.Pagination(
-        page, FLAGS.pagination_items_per_page, count)
     template_dict = {
         'solutions': solutions,
         'team_display_name_map': team_display_name_map,
@@ -812,3 +862,22 @@ def testing_cron_snapshot_job_handler():
         bottle.abort(403, 'Disabled')
     cron_jobs.snapshot_job()
     return 'done'
+
+
+@bottle.get('/testing/judge/abandon_job/<job_id>')
+def testing_judge_abandon_job_handler(job_id):
+    if not FLAGS.enable_testing_handlers:
+        bottle.abort(403, 'Disabled')
+    model.abandon_judge_job_for_testing(job_id)
+    return 'done'
+
+
+@bottle.get('/testing/snapshot/problem_rankings')
+def testing_snapshot_problem_rankings_handler():
+    if not FLAGS.enable_testing_handlers:
+        bottle.abort(403, 'Disabled')
+    snapshot_time = int(bottle.request.query['snapshot_time'])
+    num_workers = int(bottle.request.query['workers'])
+    snapshots = model.compute_problem_ranking_snapshots_for_testing(
+        snapshot_time, num_workers)
+    return {'snapshots': snapshots}
@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import binascii
-import copy
 import functools
 import logging
 import os
@@ -24,6 +23,7 @@ import ujson
 
 from hibiki import misc_util
 from hibiki import model
+from hibiki import rate_limit
 from hibiki import settings
 
 FLAGS = gflags.FLAGS
@@ -40,15 +40,19 @@ _XSRF_TOKEN_COOKIE = 'xsrf_token'
 # bottle.BaseRequest.environ keys.
 _USER_DICT_ENVIRON = 'hibiki.user_dict'
 
+# Team display name maps keyed by cache keys given by callers.
+_team_display_name_map_cache = misc_util.LRUCache(max_entries=16)
 
-def get_current_user():
-    """Returns the current user.
+# Rendered HTML fragments keyed by cache keys given by callers.
+_fragment_cache = misc_util.LRUCache(max_entries=16)
 
-    Even if the username is set in the cookie, if the user does not exist in
-    backends, this function returns None.
+
+def _get_current_user_shared():
+    """Returns the current user shared in the request.
 
     Returns:
-        A user dictionary, or None if the user is not logged in.
+        A user dictionary which must not be modified, or None if the user is
+        not logged in.
     """
     def get_current_user_no_cache():
         username = bottle.request.get_cookie(
@@ -56,14 +60,29 @@ def get_current_user():
         if not username:
             return None
         try:
-            return model.get_user(username)
+            return model.get_user(username, use_cache=True)
         except KeyError:
             return None
     # Cache the result in thread local storage (LocalRequest.environ).
     if _USER_DICT_ENVIRON not in bottle.request.environ:
         bottle.request.environ[_USER_DICT_ENVIRON] = get_current_user_no_cache()
-    cached_user = bottle.request.environ[_USER_DICT_ENVIRON]
-    return copy.deepcopy(cached_user)
+    return bottle.request.environ[_USER_DICT_ENVIRON]
+
+
+def get_current_user():
+    """Returns the current user.
+
+    Even if the username is set in the cookie, if the user does not exist in
+    backends, this function returns None.
+
+    Returns:
+        A user dictionary, or None if the user is not logged in.
+    """
+    user = _get_current_user_shared()
+    if not user:
+        return None
+    # User dictionaries hold only immutable values.
+    return dict(user)
 
 
 def get_current_username():
@@ -75,7 +94,7 @@ def get_current_username():
     Returns:
         Username string, or None if the user is not logged in.
     """
-    user = get_current_user()
+    user = _get_current_user_shared()
     if not user:
         return None
     return user['_id']
@@ -87,7 +106,7 @@ def set_current_username(username):
     Args:
         username: The username. If it is None, the user is logged out.
     """
-    current_user = get_current_user()
+    current_user = _get_current_user_shared()
     assert not current_user or not current_user.get('_overridden')
     if not username:
         bottle.response.delete_cookie(_USERNAME_COOKIE)
@@ -104,9 +123,9 @@ def _override_current_user_for_api_request(user):
     Args:
         user: User dictionary.
     """
-    current_user = get_current_user()
+    current_user = _get_current_user_shared()
     assert not current_user or not current_user.get('_overridden')
-    user = copy.deepcopy(user)
+    user = dict(user)
     user['_overridden'] = True
     bottle.request.environ[_USER_DICT_ENVIRON] = user
 
@@ -170,7 +189,7 @@ def _api_auth_hook():
         return
     api_key = bottle.request.headers.get('X-API-Key', 'N/A')
     try:
-        user = model.get_user_by_api_key(api_key)
+        user = model.get_user_by_api_key(api_key, use_cache=True)
     except KeyError:
         bottle.abort(403, 'Invalid API key.')
     _override_current_user_for_api_request(user)
@@ -206,12 +225,12 @@ def _enforce_web_rate_limit_hook():
         return
     if bottle.request.path.startswith(('/health', '/ping', '/static/', '/api/', '/admin/')):
         return
-    user = get_current_user()
+    user = _get_current_user_shared()
     if not user:
         return
     if user['organizer']:
         return
-    if not model.decrement_web_rate_limit_counter(user['_id']):
+    if not rate_limit.decrement_web_rate_limit_counter(user['_id']):
         bottle.abort(429, 'Rate limit exceeded.')
 
 
@@ -226,16 +245,68 @@ def _protect_xsrf_hook():
             bottle.abort(400, 'XSRF token is incorrect or not set.')
 
 
+def accepts_gzip():
+    """Checks if the client accepts gzip-encoded responses.
+
+    Returns:
+        A boolean.
+    """
+    # nginx passes the original Accept-Encoding: as X-Accept-Encoding:.
+    accept_encoding = bottle.request.headers.get(
+        'X-Accept-Encoding',
+        bottle.request.headers.get('Accept-Encoding', ''))
+    return 'gzip' in accept_encoding
+
+
+def check_not_modified(etag, last_modified=None, cache_control='private, no-cache'):
+    """Sets cache validators and responds 304 if the client is up to date.
+
+    Call this before doing expensive work for a response, as this aborts the
+    handler if the content cached by the client is still valid. Rate limits
+    should be enforced before this. If-None-Match: * is not supported and is
+    ignored, so that it does not hide a missing resource.
+
+    Args:
+        etag: Strong entity tag of the response, without quotes.
+        last_modified: Timestamp of the last modification, or None.
+        cache_control: Value of Cache-Control: header.
+
+    Raises:
+        bottle.HTTPResponse: 304 Not Modified.
+    """
+    bottle.response.headers['Cache-Control'] = cache_control
+    bottle.response.headers['ETag'] = '"%s"' % etag
+    if last_modified is not None:
+        bottle.response.headers['Last-Modified'] = bottle.http_date(last_modified)
+    if_none_match = bottle.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # Weak comparison is used, as nginx weakens ETags of responses it
+        # compresses. Only concrete ETags are compared.
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        not_modified = any(
+            tag.replace('W/', '', 1) == '"%s"' % etag for tag in tags)
+    elif last_modified is not None:
+        if_modified_since = bottle.parse_date(
+            bottle.request.headers.get('If-Modified-Since', '').split(';')[0].strip())
+        not_modified = (
+            if_modified_since is not None and
+            if_modified_since >= int(last_modified))
+    else:
+        not_modified = False
+    if not_modified:
+        response = bottle.response.copy(cls=bottle.HTTPResponse)
+        response.status = 304
+        response.body = ''
+        raise response
+
+
 def _require_gzip_hook():
     """Before-request hook to require gzip for API requests."""
     if (FLAGS.enable_load_test_hacks and
             bottle.request.headers.get('X-Load-Test', '') == 'yes'):
         return
     if bottle.request.path.startswith('/api/'):
-        accept_encoding = bottle.request.headers.get(
-            'X-Accept-Encoding',
-            bottle.request.headers.get('Accept-Encoding', ''))
-        if 'gzip' not in accept_encoding:
+        if not accepts_gzip():
             bottle.abort(
                 400, 'Accept-Encoding: gzip is required for API requests')
 
@@ -319,6 +390,9 @@ def json_api_handler(handler):
         except Exception:
             logging.exception('Uncaught exception')
             handler_result = bottle.HTTPError(500, 'Internal Server Error')
+        if (isinstance(handler_result, bottle.HTTPResponse) and
+                handler_result.status_code == 304):
+            return handler_result
         if isinstance(handler_result, bottle.HTTPResponse):
             # For now, we do not support raising successful HTTPResponse.
             assert handler_result.status_code // 100 != 2
@@ -360,6 +434,38 @@ def render(template_name, template_dict):
         template_settings={'autoescape': True})
 
 
+def render_fragment(cache_key, template_name, compute_template_dict):
+    """Renders a HTML fragment shared by all users.
+
+    Unlike render(), the template is rendered without user-specific values,
+    so the result is cached in the process memory.
+
+    Args:
+        cache_key: A key identifying the content of the fragment.
+        template_name: The filename of the template.
+        compute_template_dict: A function returning a dictionary filled into
+            the template. Called only if the fragment is not cached.
+
+    Returns:
+        A rendered HTML string.
+    """
+    use_cache = not FLAGS.disable_model_cache_for_testing
+    if use_cache:
+        fragment = _fragment_cache.get(cache_key)
+        if fragment is not None:
+            return fragment
+    real_template_dict = {
+        'format_timestamp': misc_util.format_timestamp,
+    }
+    real_template_dict.update(compute_template_dict())
+    fragment = bottle.jinja2_template(
+        template_name, real_template_dict,
+        template_settings={'autoescape': True})
+    if use_cache:
+        _fragment_cache.put(cache_key, fragment)
+    return fragment
+
+
 def get_form_string(key, max_length, allow_empty=False):
     """Returns a form string after validating the value.
 
@@ -404,21 +510,33 @@ def parse_basic_profile_forms():
     }
 
 
-def compute_team_display_name_map(usernames):
+def compute_team_display_name_map(usernames, cache_key=None):
     """Computes team display_name map.
 
     Args:
         username: List of usernames.
+        cache_key: If set, the map is cached in the process memory with this
+            key. The same key must always be given with the same usernames,
+            e.g. a key identifying a snapshot. Display name changes are not
+            reflected until the key changes.
 
     Returns:
-        A dictionary mapping usernames to display names.
+        A dictionary mapping usernames to display names. It must not be
+        modified.
     """
+    use_cache = cache_key is not None and not FLAGS.disable_model_cache_for_testing
+    if use_cache:
+        team_display_name_map = _team_display_name_map_cache.get(cache_key)
+        if team_display_name_map is not None:
+            return team_display_name_map
     usernames = list(set(usernames))
     user_map = model.get_user_map(usernames)
     team_display_name_map = {
         username: user_map.get(username, {}).get('display_name', '???')
         for username in usernames
     }
+    if use_cache:
+        _team_display_name_map_cache.put(cache_key, team_display_name_map)
     return team_display_name_map
 
 
@@ -480,35 +598,69 @@ def enforce_api_rate_limit(action, limit_in_window):
     if (FLAGS.enable_load_test_hacks and
             bottle.request.headers.get('X-Load-Test', '') == 'yes'):
         return
-    if get_current_user()['organizer']:
+    if _get_current_user_shared()['organizer']:
         return
     username = get_current_username()
-    if (model.record_last_api_access_time(username) <
-            FLAGS.api_rate_limit_request_interval):
+    count = rate_limit.record_api_request(username, action)
+    if count is None:
         bottle.abort(429, 'Rate limit exceeded (per-second limit).')
-    count = model.increment_api_rate_limit_counter(username, action)
     if count > limit_in_window:
         bottle.abort(429, 'Rate limit exceeded (per-hour limit).')
 
 
-# http://flask.pocoo.org/snippets/44/
 class Pagination(object):
-    def __init__(self, current_page, items_per_page, total_items):
-        self.current_page = current_page
-        self.items_per_page = items_per_page
+    """Keyset pagination of a list sorted by _id.
+
+    Pages are specified by "after" and "before" query parameters holding _id
+    of the items next to the page, instead of page numbers. Thus only the
+    first page can be linked by its position.
+
+    prev_before is None if the page has no item to page back from, e.g. an
+    "after" cursor past the last item. Only the first page is linked then.
+    """
+
+    def __init__(self, items, has_prev, has_next, total_items):
+        self.has_prev = has_prev
+        self.has_next = has_next
         self.total_items = total_items
-        self.last_page = (
-            (self.total_items + self.items_per_page - 1) / self.items_per_page)
-        self.has_prev = self.current_page > 1
-        self.has_next = self.current_page < self.last_page
-
-    def iter_pages(self):
-        last_printed_page = 0
-        for page in xrange(1, self.last_page + 1):
-            if (page <= 2 or
-                    (self.current_page - 2 <= page <= self.current_page + 5) or
-                    self.last_page - 1 <= page):
-                if page != last_printed_page + 1:
-                    yield None  # ellapsis
-                yield page
-                last_printed_page = page
+        if items:
+            self.prev_before = items[0]['_id']
+            self.next_after = items[-1]['_id']
+        else:
+            self.prev_before = None
+            self.next_after = None
+
+
+def _get_query_int(key):
+    try:
+        return int(bottle.request.query[key])
+    except (KeyError, ValueError):
+        return None
+
+
+def paginate(fetch, items_per_page, total_items):
+    """Fetches the page of items specified by the request.
+
+    Args:
+        fetch: A function taking after, before and limit keyword arguments and
+            returning a list of items sorted by _id, e.g.
+            model.get_public_problems.
+        items_per_page: The number of items in a page.
+        total_items: The number of all items.
+
+    Returns:
+        (items, pagination)
+    """
+    after = _get_query_int('after')
+    before = _get_query_int('before')
+    if before is not None:
+        items = fetch(before=before, limit=items_per_page + 1)
+        if len(items) > items_per_page:
+            items = items[1:]
+            return (items, Pagination(items, True, True, total_items))
+        # Fewer items precede; show the first page instead.
+        after = None
+    items = fetch(after=after, limit=items_per_page + 1)
+    has_next = len(items) > items_per_page
+    items = items[:items_per_page]
+    return (items, Pagination(items, after is not None, has_next, total_items))
@@ -0,0 +1,294 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+
+import gflags
+import subprocess32 as subprocess
+
+from hibiki import eventlog
+from hibiki import game
+from hibiki import misc_util
+from hibiki import model
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer(
+    'judge_cache_max_entries', 100000,
+    'Maximum number of judge results cached in each app process.')
+gflags.DEFINE_enum(
+    'async_judge', 'never', ['never', 'optional', 'always'],
+    'When API submissions are queued as judge jobs instead of being judged in '
+    'the request. With "optional", only submissions with async=1 are queued. '
+    'Unless "never", judge_runner_main must be running.')
+
+# Judge results keyed by (problem_spec_hash, solution_spec_hash). Values are
+# (resemblance_int, processing_time) tuples.
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+# Cumulative counts of lookups missing the process cache, by their results.
+# Hits of the process cache are counted by _result_cache itself.
+_shared_cache_stats = {
+    'shared_hits': 0,
+    'misses': 0,
+}
+_shared_cache_stats_lock = threading.Lock()
+
+
+def _get_result_cache():
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = misc_util.LRUCache(FLAGS.judge_cache_max_entries)
+        return _result_cache
+
+
+def _get_cache_stats():
+    stats = _get_result_cache().get_stats()
+    with _shared_cache_stats_lock:
+        stats.update(_shared_cache_stats)
+    return stats
+
+
+def _record_shared_cache_lookup(result):
+    with _shared_cache_stats_lock:
+        _shared_cache_stats[result] += 1
+
+
+def evaluate_solution(problem_spec_hash, solution_spec):
+    """Evaluates a solution submission, reusing cached results if possible.
+
+    Judge results are cached in the process memory and in the database,
+    keyed by the problem spec hash and the normalized solution spec hash.
+    Cache statistics are emitted as judge_cache events periodically.
+
+    Args:
+        problem_spec_hash: Problem specification hash string.
+        solution_spec: Normalized specification string of a solution.
+
+    Returns:
+        (resemblance_int, processing_time) where processing_time is the time
+        in seconds it took to judge the solution when it was first evaluated.
+
+    Raises:
+        VerificationError: If any of the specifications are invalid.
+        subprocess.TimeoutExpired: On judge timeout.
+        AssertionError: On scrape error.
+    """
+    solution_spec_hash = model.compute_blob_key(solution_spec)
+    key = (problem_spec_hash, solution_spec_hash)
+    use_local_cache = not FLAGS.disable_model_cache_for_testing
+    try:
+        if use_local_cache:
+            result = _get_result_cache().get(key)
+            if result is not None:
+                return result
+
+        result = model.get_cached_evaluation(
+            problem_spec_hash, solution_spec_hash)
+        if result is not None:
+            _record_shared_cache_lookup('shared_hits')
+        else:
+            _record_shared_cache_lookup('misses')
+            with eventlog.record_time('judge') as record:
+                problem_spec = model.load_blob(problem_spec_hash)
+                resemblance_int, _ = game.evaluate_solution(
+                    problem_spec, solution_spec)
+            result = (resemblance_int, record['processing_time'])
+            model.set_cached_evaluation(
+                problem_spec_hash, solution_spec_hash, *result)
+
+        if use_local_cache:
+            _get_result_cache().put(key, result)
+        return result
+    finally:
+        eventlog.emit_periodically('judge_cache', _get_cache_stats)
+
+
+class SubmissionError(Exception):
+    """Raised when a submission is rejected for a reason shown to the user."""
+
+    def __init__(self, message):
+        super(SubmissionError, self).__init__(message)
+        self.message = message
+
+
+def format_solution_result(solution):
+    """Formats a registered solution as an API response.
+
+    Args:
+        solution: A solution dictionary.
+
+    Returns:
+        A dictionary.
+    """
+    return {
+        'problem_id': solution['problem_id'],
+        'solution_spec_hash': solution['solution_spec_hash'],
+        'solution_size': solution['solution_size'],
+        'resemblance': solution['resemblance_int'] / 1000000.0,
+    }
+
+
+def format_problem_result(problem):
+    """Formats a registered problem as an API response.
+
+    Args:
+        problem: A problem dictionary.
+
+    Returns:
+        A dictionary.
+    """
+    return {
+        'problem_id': problem['_id'],
+        'publish_time': problem['publish_time'],
+        'problem_spec_hash': problem['problem_spec_hash'],
+        'problem_size': problem['problem_size'],
+        'solution_spec_hash': problem['solution_spec_hash'],
+        'solution_size': problem['solution_size'],
+    }
+
+
+def judge_solution_submission(
+        owner, params, create_time=None, solution_id=None):
+    """Judges a solution submission and registers the solution.
+
+    This is shared by API requests and judge jobs, so that they judge
+    submissions in the same way.
+
+    Args:
+        owner: Owner username.
+        params: Dictionary of submission parameters: problem_id,
+            problem_spec_hash, and solution_spec and solution_size returned by
+            game.normalize_solution().
+        create_time: Timestamp when the solution was submitted. If None, the
+            current time after judging is used.
+        solution_id: Numeric ID to register the solution with. See
+            model.register_solution().
+
+    Returns:
+        A dictionary of the API response.
+
+    Raises:
+        VerificationError: If any of the specifications are invalid.
+        subprocess.TimeoutExpired: On judge timeout.
+    """
+    resemblance_int, processing_time = evaluate_solution(
+        params['problem_spec_hash'], params['solution_spec'])
+    new_solution = model.register_solution(
+        owner=owner,
+        problem_id=params['problem_id'],
+        problem_spec_hash=params['problem_spec_hash'],
+        solution_spec=params['solution_spec'],
+        solution_size=params['solution_size'],
+        resemblance_int=resemblance_int,
+        processing_time=processing_time,
+        create_time=create_time,
+        solution_id=solution_id)
+    return format_solution_result(new_solution)
+
+
+def judge_problem_submission(
+        owner, params, create_time=None, problem_id=None):
+    """Judges a problem submission and registers the problem.
+
+    This is shared by API requests and judge jobs, so that they judge
+    submissions in the same way.
+
+    Args:
+        owner: Owner username.
+        params: Dictionary of submission parameters: publish_time, organizer,
+            and solution_spec and solution_size returned by
+            game.normalize_solution().
+        create_time: Timestamp when the problem was submitted. If None, the
+            current time after judging is used.
+        problem_id: Numeric ID to register the problem with. See
+            model.enqueue_problem().
+
+    Returns:
+        A dictionary of the API response.
+
+    Raises:
+        VerificationError: If the solution specification is invalid.
+        SubmissionError: If the publish time has passed.
+        subprocess.TimeoutExpired: On judge timeout.
+    """
+    with eventlog.record_time('judge') as record:
+        problem_spec, problem_size = game.compile_problem(params['solution_spec'])
+    if create_time is None:
+        create_time = misc_util.time()
+    if not params['organizer'] and params['publish_time'] < create_time:
+        raise SubmissionError('Missed the publish time.')
+    new_problem = model.enqueue_problem(
+        owner=owner,
+        problem_spec=problem_spec,
+        problem_size=problem_size,
+        solution_spec=params['solution_spec'],
+        solution_size=params['solution_size'],
+        create_time=create_time,
+        publish_time=params['publish_time'],
+        processing_time=record['processing_time'],
+        publish_immediately=params['organizer'],
+        problem_id=problem_id)
+    return format_problem_result(new_problem)
+
+
+def run_job(job):
+    """Runs a judge job claimed by model.claim_judge_job() and records it.
+
+    A job claimed again after its runner crashed does not register another
+    problem or solution: if the registration under the reserved ID is already
+    done, the job is just finished with it.
+
+    Args:
+        job: A job dictionary.
+    """
+    def finish(**kwargs):
+        if not model.finish_judge_job(job['_id'], job['claim_time'], **kwargs):
+            logging.warning(
+                'judge job was claimed by another runner: %s', job['_id'])
+
+    try:
+        registered_id = model.reserve_judge_job_registered_id(job)
+        # The submission was accepted at the job creation time.
+        if job['kind'] == 'solution':
+            try:
+                result = format_solution_result(
+                    model.get_solution_for_admin(registered_id))
+            except KeyError:
+                result = judge_solution_submission(
+                    job['owner'], job['params'],
+                    create_time=job['create_time'], solution_id=registered_id)
+        else:
+            try:
+                result = format_problem_result(
+                    model.get_problem_for_admin(registered_id))
+            except KeyError:
+                result = judge_problem_submission(
+                    job['owner'], job['params'],
+                    create_time=job['create_time'], problem_id=registered_id)
+    except game.VerificationError as e:
+        finish(error='Invalid solution spec: %s' % e.message)
+    except SubmissionError as e:
+        finish(error=e.message)
+    except subprocess.TimeoutExpired:
+        eventlog.exception('judge job timeout: %s', job['_id'])
+        finish(error='Judge timed out.')
+    except Exception:
+        eventlog.exception('judge job failure: %s', job['_id'])
+        finish(error='Internal Server Error')
+    else:
+        finish(result=result)
@@ -0,0 +1,87 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import signal
+import sys
+import threading
+
+import gflags
+
+# In order to pull flag definitions.
+from hibiki import devserver_main as _devserver_main_import_only
+from hibiki import eventlog
+from hibiki import judge
+from hibiki import misc_util
+from hibiki import model
+from hibiki import setup
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer(
+    'judge_runner_threads', 4,
+    'Number of judge jobs processed concurrently.')
+gflags.DEFINE_float(
+    'judge_runner_poll_interval', 0.5,
+    'Seconds to wait before polling again when the job queue is empty.')
+gflags.DEFINE_integer(
+    'judge_runner_stale_job_seconds', 120,
+    'Seconds after which a running job is considered abandoned and retried.')
+
+
+def _run_jobs(shutdown_event):
+    while not shutdown_event.is_set():
+        try:
+            job = model.claim_judge_job(
+                misc_util.time() - FLAGS.judge_runner_stale_job_seconds)
+        except Exception:
+            eventlog.exception('failed to claim a judge job')
+            job = None
+        if not job:
+            shutdown_event.wait(FLAGS.judge_runner_poll_interval)
+            continue
+        try:
+            judge.run_job(job)
+        except Exception:
+            eventlog.exception('judge job failure: %s', job['_id'])
+
+
+def main():
+    setup.setup_common()
+    model.connect()
+
+    shutdown_event = threading.Event()
+    def shutdown_handler(signum, frame):
+        shutdown_event.set()
+    signal.signal(signal.SIGTERM, shutdown_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
+
+    threads = [
+        threading.Thread(target=_run_jobs, args=(shutdown_event,))
+        for _ in xrange(FLAGS.judge_runner_threads)]
+    for thread in threads:
+        thread.start()
+
+    # We need to set some timeout to allow signal handler interruption.
+    while shutdown_event.wait(283) != True:
+        pass
+
+    logging.info('Gracefully shutting down the judge runner process')
+    for thread in threads:
+        thread.join()
+    logging.info('Finished the judge runner process')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
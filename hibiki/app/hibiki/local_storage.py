@@ -0,0 +1,100 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed blob storage on a local directory.
+
+Blobs are stored at <root>/<key[0:2]>/<key[2:4]>/<key>.
+"""
+
+import errno
+import os
+import re
+import tempfile
+
+_KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+
+_root_dir = None
+
+
+def connect(root_dir):
+    global _root_dir
+    if not os.path.isdir(root_dir):
+        os.makedirs(root_dir)
+    _root_dir = root_dir
+
+
+def _get_path(key):
+    if not _KEY_RE.match(key):
+        raise KeyError('Invalid blob key: %s' % key)
+    return os.path.join(_root_dir, key[0:2], key[2:4], key)
+
+
+def exists(key):
+    try:
+        return os.path.exists(_get_path(key))
+    except KeyError:
+        return False
+
+
+def save(key, binary):
+    """Saves a blob atomically.
+
+    Args:
+        key: A blob key.
+        binary: A str.
+    """
+    path = _get_path(key)
+    if os.path.exists(path):
+        return
+    shard_dir = os.path.dirname(path)
+    try:
+        os.makedirs(shard_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Write to a temporary file in the same directory, then rename it so that
+    # readers never see a partially written blob.
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=shard_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(binary)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(key):
+    """Loads a blob.
+
+    Args:
+        key: A blob key.
+
+    Returns:
+        str.
+
+    Raises:
+        KeyError: Blob was not found.
+    """
+    try:
+        f = open(_get_path(key), 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            raise KeyError('Blob not found: %s' % key)
+        raise
+    with f:
+        return f.read()
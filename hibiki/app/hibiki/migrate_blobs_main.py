@@ -0,0 +1,47 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Copies blobs in the database to the local blob storage.
+
+Usage:
+    python -m hibiki.migrate_blobs_main --flagfile=... --storage_local_dir=...
+"""
+
+import logging
+import sys
+
+import gflags
+
+# In order to pull flag definitions.
+from hibiki import devserver_main as _devserver_main_import_only
+from hibiki import model
+from hibiki import setup
+
+FLAGS = gflags.FLAGS
+
+
+def main():
+    setup.setup_common()
+    if not FLAGS.storage_local_dir or FLAGS.storage_gcs_bucket_name:
+        logging.error(
+            '--storage_local_dir must be set without --storage_gcs_bucket_name')
+        return 1
+    model.connect()
+    copied, skipped = model.migrate_blobs_to_local_storage()
+    logging.info('Copied %d blobs, skipped %d existing blobs', copied, skipped)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,10 +13,14 @@
 # limitations under the License.
 
 import binascii
+import collections
+import cStringIO
 import datetime
+import gzip
 import math
 import os
 import random
+import threading
 import time as time_lib
 
 import bottle
@@ -95,6 +99,34 @@ def load_testdata(name):
         return f.read()
 
 
+def gzip_compress(data):
+    """Compresses a str in the gzip format.
+
+    Args:
+        data: A str.
+
+    Returns:
+        A str.
+    """
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_stream:
+        gzip_stream.write(data)
+    return buf.getvalue()
+
+
+def gzip_decompress(data):
+    """Decompresses a str in the gzip format.
+
+    Args:
+        data: A str.
+
+    Returns:
+        A str.
+    """
+    with gzip.GzipFile(fileobj=cStringIO.StringIO(data), mode='rb') as gzip_stream:
+        return gzip_stream.read()
+
+
 def time():
     """Returns the current time.
 
@@ -108,3 +140,98 @@ def time():
         if override_time:
             return float(override_time)
     return time_lib.time()
+
+
+class LRUCache(object):
+    """A thread-safe in-memory LRU cache."""
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        """Initializes the cache.
+
+        Args:
+            max_entries: Maximum number of entries kept in the cache.
+            max_bytes: Maximum total length of values kept in the cache.
+                Values must be str if this is set.
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Looks up an entry and marks it as recently used.
+
+        Args:
+            key: Cache key.
+            default: Value returned if the key is not cached.
+
+        Returns:
+            The cached value, or |default|.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self._stats['misses'] += 1
+                return default
+            self._stats['hits'] += 1
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """Adds an entry, evicting the least recently used ones if needed.
+
+        Values larger than the whole cache are not added.
+
+        Args:
+            key: Cache key.
+            value: Value to cache.
+        """
+        if self._max_bytes is not None and len(value) > self._max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = value
+            if self._max_bytes is not None:
+                self._total_bytes += len(value)
+            while ((self._max_entries is not None and
+                    len(self._entries) > self._max_entries) or
+                   (self._max_bytes is not None and
+                    self._total_bytes > self._max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def delete(self, key):
+        """Removes an entry if it exists.
+
+        Args:
+            key: Cache key.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def get_stats(self):
+        """Returns cumulative statistics of the cache.
+
+        Returns:
+            A dictionary with hits, misses, evictions, entries and bytes.
+        """
+        with self._lock:
+            stats = self._stats.copy()
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._total_bytes
+            return stats
+
+    def _remove(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return
+        if self._max_bytes is not None:
+            self._total_bytes -= len(value)
@@ -12,10 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import datetime
 import hashlib
+import itertools
 import json
 import logging
+import multiprocessing.pool
 import os
+import threading
 
 import bson.binary
 import gflags
@@ -25,6 +30,8 @@ import pymongo.collection
 import pymongo.errors
 import ujson
 
+from hibiki import eventlog
+from hibiki import local_storage
 from hibiki import misc_util
 from hibiki import scoring
 from hibiki import settings
@@ -44,9 +51,45 @@ gflags.DEFINE_bool(
 gflags.DEFINE_string(
     'storage_gcs_bucket_name', None,
     'Name of the GCS bucket used to storage large blobs.')
+gflags.DEFINE_string(
+    'storage_local_dir', None,
+    'Path to a local directory used to store large blobs. Ignored if '
+    '--storage_gcs_bucket_name is set.')
 gflags.DEFINE_bool(
     'disable_model_cache_for_testing', False,
     'Disables model caching for testing.')
+gflags.DEFINE_integer(
+    'blob_cache_max_bytes', 64 * 1024 * 1024,
+    'Maximum total size of blobs cached by load_blob() in each process. '
+    'Set to 0 to disable the cache.')
+gflags.DEFINE_integer(
+    'id_block_size', 1,
+    'Number of problem and solution IDs reserved by each process at once. '
+    'If larger than 1, IDs increase only within each process, so ties in '
+    'rankings broken by solution IDs may not favor earlier submissions. '
+    'The cached solution count is also updated once per block.')
+gflags.DEFINE_integer(
+    'user_cache_ttl', 10,
+    'Seconds to cache users looked up with use_cache=True in each process. '
+    'Set to 0 to disable the cache.')
+gflags.DEFINE_integer(
+    'user_cache_max_entries', 10000,
+    'Maximum number of users cached in each process.')
+gflags.DEFINE_integer(
+    'snapshot_cache_max_entries', 500,
+    'Maximum number of latest leaderboard and problem ranking snapshots '
+    'cached in each process.')
+gflags.DEFINE_enum(
+    'ranking_snapshot_builder', 'loop', ['loop', 'aggregation'],
+    'How problem rankings are computed in snapshot cron jobs. "loop" queries '
+    'new solutions problem by problem, "aggregation" reduces them with a '
+    'single aggregation for all problems.')
+gflags.DEFINE_integer(
+    'snapshot_write_batch_size', 500,
+    'Maximum number of snapshot writes sent to MongoDB in one bulk write.')
+gflags.DEFINE_integer(
+    'snapshot_workers', 1,
+    'Number of threads computing problem ranking snapshots in parallel.')
 
 # MongoClient instance.
 _client = None
@@ -54,6 +97,41 @@ _client = None
 # Collection instance.
 _db = None
 
+# LRU cache of blobs keyed by blob keys. Blobs are immutable.
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+
+# LRU cache of the latest snapshots. Values are
+# (snapshot_time, ranking, check_time) tuples.
+_snapshot_cache = None
+_snapshot_cache_lock = threading.Lock()
+
+# Minimum interval in seconds between version checks of a cached snapshot
+# that may have been superseded.
+_SNAPSHOT_CACHE_CHECK_INTERVAL = 5
+
+# ID blocks reserved by _allocate_id(), keyed by counter names. Values are
+# (next_id, last_id) tuples.
+_id_blocks = {}
+_id_blocks_lock = threading.Lock()
+
+# Additions to cached document counts not yet applied by _add_to_count(),
+# keyed by counter names.
+_pending_counts = {}
+_pending_counts_lock = threading.Lock()
+
+# LRU cache of users. Keys are ('username', username) mapped to
+# (user, expire_time) and ('api_key', api_key) mapped to usernames.
+_user_cache = None
+_user_cache_lock = threading.Lock()
+
+# Cached document counts as (counter name, collection name, query).
+_COUNTED_DOCUMENTS = [
+    ('problem_count', 'problems', {}),
+    ('public_problem_count', 'problems', {'public': True}),
+    ('solution_count', 'solutions', {}),
+]
+
 # The master secret key used to sign cookies.
 _cookie_master_secret = None
 
@@ -75,9 +153,11 @@ def connect():
     assert server_version >= (2, 6), (
         'MongoDB server version is old. Please upgrade to 2.6+.')
 
-    # Connect to GCS if enabled.
+    # Connect to GCS or local storage if enabled.
     if FLAGS.storage_gcs_bucket_name:
         storage.connect(FLAGS.storage_gcs_bucket_name)
+    elif FLAGS.storage_local_dir:
+        local_storage.connect(FLAGS.storage_local_dir)
 
     _init_model()
 
@@ -85,6 +165,8 @@ def connect():
 def _init_model():
     _ensure_cookie_secret()
     _ensure_indices()
+    _ensure_counts()
+    _migrate_api_rate_limits()
     _ensure_organizer_users()
 
 
@@ -191,6 +273,51 @@ def _ensure_indices():
     _db.solutions.create_index([
         ('owner', pymongo.ASCENDING),
     ], background=True)
+    _db.solutions.create_index([
+        ('owner', pymongo.ASCENDING),
+        ('problem_id', pymongo.ASCENDING),
+        ('resemblance_int', pymongo.DESCENDING),
+        ('_id', pymongo.ASCENDING),
+    ], background=True)
+    # For claim_judge_job()
+    _db.judge_jobs.create_index([
+        ('status', pymongo.ASCENDING),
+        ('create_time', pymongo.ASCENDING),
+    ], background=True)
+    # Expire finished windows of record_api_request().
+    _db.api_rate_limits.create_index([
+        ('expire_time', pymongo.ASCENDING),
+    ], background=True, expireAfterSeconds=0)
+    # Expire old locks of lock_snapshot_cron_job().
+    _db.cron_locks.create_index([
+        ('expire_time', pymongo.ASCENDING),
+    ], background=True, expireAfterSeconds=0)
+    # For remove_secondary_snapshots()
+    _db.problem_ranking_snapshots.create_index([
+        ('public', pymongo.ASCENDING),
+        ('snapshot_time', pymongo.ASCENDING),
+    ], background=True)
+
+
+def _migrate_api_rate_limits():
+    """Sets expire_time of API rate limit documents in the old format.
+
+    Old documents are keyed by "<action>:<window>:<username>" and have no
+    expire_time, so the TTL index would keep them forever. They are no longer
+    read, and are removed once their window has passed like new documents.
+    """
+    requests = []
+    for entry in _db.api_rate_limits.find(
+            {'expire_time': {'$exists': False}}, projection=['_id']):
+        try:
+            _, window_time, _ = entry['_id'].split(':', 2)
+            _, expire_time = _get_api_rate_limit_window(int(window_time))
+        except ValueError:
+            expire_time = datetime.datetime.utcfromtimestamp(0)
+        requests.append(pymongo.UpdateOne(
+            {'_id': entry['_id']}, {'$set': {'expire_time': expire_time}}))
+    if requests:
+        _db.api_rate_limits.bulk_write(requests, ordered=False)
 
 
 def _ensure_organizer_users():
@@ -233,84 +360,286 @@ def _maybe_explain_query(cursor):
                 cursor.explain()['queryPlanner']['winningPlan'], indent=2))
 
 
-def _increment_atomic_counter(key):
+def _increment_atomic_counter(key, amount=1):
     try:
         entry = _db.config.find_one_and_update(
             {'_id': key},
             {
                 '$setOnInsert': {'_id': key},
-                '$inc': {'value': 1},
+                '$inc': {'value': amount},
             },
             upsert=True,
             return_document=pymongo.collection.ReturnDocument.AFTER)
     except pymongo.errors.DuplicateKeyError:
         entry = _db.config.find_one_and_update(
             {'_id': key},
-            {'$inc': {'value': 1}},
+            {'$inc': {'value': amount}},
             return_document=pymongo.collection.ReturnDocument.AFTER)
     return entry['value']
 
 
-def record_last_api_access_time(username):
-    """Sets the last API access time.
+def _allocate_id(key):
+    """Allocates a new ID from a counter.
+
+    If --id_block_size is larger than 1, a block of IDs is reserved with a
+    single update and handed out in the process, so that concurrent
+    submissions do not serialize on the counter document. IDs are still
+    unique, but IDs allocated by different processes interleave, so their
+    order may differ from the creation order. Unused IDs of a block are
+    skipped when the process exits.
+
+    Args:
+        key: Counter name.
+
+    Returns:
+        A new ID.
+    """
+    block_size = FLAGS.id_block_size
+    if block_size <= 1:
+        return _increment_atomic_counter(key)
+    with _id_blocks_lock:
+        next_id, last_id = _id_blocks.get(key, (1, 0))
+        if next_id > last_id:
+            last_id = _increment_atomic_counter(key, block_size)
+            next_id = last_id - block_size + 1
+        _id_blocks[key] = (next_id + 1, last_id)
+        return next_id
+
+
+def _get_atomic_counter(key):
+    entry = _db.config.find_one({'_id': key})
+    if not entry:
+        return 0
+    return entry['value']
+
+
+def _ensure_counts():
+    """Makes sure cached document counts are initialized.
+
+    Counts are counted once here and then maintained with _add_to_count() by
+    functions inserting or publishing documents, so that paginated lists do
+    not count collections. A counter is created only by the upsert here, so
+    increments never race with its initial value. Increments made while the
+    counter is being created may be lost, and reconcile_counts() corrects
+    them later.
+    """
+    for key, collection_name, query in _COUNTED_DOCUMENTS:
+        if _db.config.find_one({'_id': key}):
+            continue
+        count = _db[collection_name].find(query).count()
+        try:
+            _db.config.update_one(
+                {'_id': key},
+                {'$setOnInsert': {'value': count}},
+                upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            pass
+
+
+def _add_to_count(key, amount=1, batch=False):
+    """Adds to a cached document count initialized by _ensure_counts().
+
+    Args:
+        key: Counter name.
+        amount: The number to add.
+        batch: If True and --id_block_size is larger than 1, additions are
+            accumulated in the process and applied with a single update once
+            they reach the block size, like IDs of _allocate_id(). Additions
+            not applied when the process exits are corrected by
+            reconcile_counts().
+    """
+    block_size = FLAGS.id_block_size
+    if batch and block_size > 1:
+        with _pending_counts_lock:
+            amount += _pending_counts.pop(key, 0)
+            if amount < block_size:
+                _pending_counts[key] = amount
+                return
+    _db.config.update_one({'_id': key}, {'$inc': {'value': amount}})
+
+
+def reconcile_counts():
+    """Corrects cached document counts with the actual counts.
+
+    A counter is updated only if it has not changed while the collection is
+    counted, so that concurrent increments are not overwritten. Additions
+    batched by app processes are applied later, so the counts may be off by
+    up to --id_block_size per process until the next run.
+    """
+    for key, collection_name, query in _COUNTED_DOCUMENTS:
+        value = _get_atomic_counter(key)
+        count = _db[collection_name].find(query).count()
+        if count == value:
+            continue
+        try:
+            _db.config.update_one(
+                {'_id': key, 'value': value},
+                {'$set': {'value': count}},
+                upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # The counter has changed. Try again next time.
+            continue
+        logging.info('Reconciled %s: %d -> %d', key, value, count)
+
+
+def _find_page(collection, query, after, before, options):
+    """Finds documents with keyset pagination.
+
+    Documents are selected by comparing _id with the given cursors instead of
+    skipping preceding documents, so the cost does not depend on the page.
+
+    Args:
+        collection: A collection instance.
+        query: Query dictionary.
+        after: If set, only documents whose _id is greater are returned.
+        before: If set, only documents whose _id is less are returned. If
+            after is not set, documents closest to it are returned.
+        options: Options passed to query.
+
+    Returns:
+        A list of documents sorted by _id.
+    """
+    id_query = {}
+    if after is not None:
+        id_query['$gt'] = after
+    if before is not None:
+        id_query['$lt'] = before
+    if id_query:
+        query = dict(query, _id=id_query)
+    if before is not None and after is None:
+        cursor = collection.find(
+            query,
+            sort=[('_id', pymongo.DESCENDING)],
+            **options)
+        return list(cursor)[::-1]
+    cursor = collection.find(
+        query,
+        sort=[('_id', pymongo.ASCENDING)],
+        **options)
+    return list(cursor)
+
+
+def _get_api_rate_limit_window(now):
+    """Returns the API rate limit window containing a time.
+
+    Returns:
+        (window_time, expire_time). expire_time is a datetime for the TTL
+        index on api_rate_limits.
+    """
+    window_time = misc_util.align_timestamp(
+        now, FLAGS.contest_start_time, FLAGS.api_rate_limit_window_size)
+    expire_time = datetime.datetime.utcfromtimestamp(
+        window_time + FLAGS.api_rate_limit_window_size)
+    return (window_time, expire_time)
+
+
+def record_api_request(username, action):
+    """Records an API request for rate limiting.
+
+    A request must come --api_rate_limit_request_interval seconds after the
+    last one, and requests are counted in a window whose length is defined
+    by --api_rate_limit_window_size. Both are kept in a single document per
+    user and window, so that a request usually costs one find_one_and_update.
+    The first request in a window also reads the last access time of the
+    previous window.
 
     Args:
         username: Username.
+        action: Action name.
 
     Returns:
-        The number of seconds since the last access.
+        The number of requests of the action in the current window including
+        this one, or None if the request came too soon after the last one.
+        Such requests are not counted.
     """
     now = misc_util.time()
+    interval = FLAGS.api_rate_limit_request_interval
+    window_time, expire_time = _get_api_rate_limit_window(now)
+    key = '%d:%s' % (window_time, username)
+    field = 'counts.%s' % action
+    query = {'_id': key}
+    if interval > 0:
+        # With the time guard, the upsert of a request coming too soon tries
+        # to insert a document with the existing _id and fails.
+        query['last_access_time'] = {'$lte': now - interval}
+    update = {
+        '$setOnInsert': {
+            '_id': key,
+            'expire_time': expire_time,
+        },
+        '$set': {'last_access_time': now},
+        '$inc': {field: 1},
+    }
     try:
-        entry = _db.api_last_accesses.find_one_and_update(
-            {'_id': username},
-            {
-                '$setOnInsert': {'_id': username},
-                '$set': {'last_access_time': now},
-            },
+        entry = _db.api_rate_limits.find_one_and_update(
+            query,
+            update,
+            projection=['counts'],
             upsert=True,
-            return_document=pymongo.collection.ReturnDocument.BEFORE)
+            return_document=pymongo.collection.ReturnDocument.AFTER)
     except pymongo.errors.DuplicateKeyError:
-        entry = _db.api_last_accesses.find_one_and_update(
-            {'_id': username},
-            {'$set': {'last_access_time': now}},
-            return_document=pymongo.collection.ReturnDocument.BEFORE)
-    if not entry:
-        return 86400  # almost forever
-    return now - entry['last_access_time']
-
-
-def increment_api_rate_limit_counter(username, action):
-    """Increments API rate limit counter.
-
-    API rate limit is implemented by simply counting requests in a window
-    whose length is defined by --api_rate_limit_window_size.
+        # The document exists: either the request came too soon, or another
+        # first request of the window inserted it concurrently.
+        del update['$setOnInsert']
+        entry = _db.api_rate_limits.find_one_and_update(
+            query,
+            update,
+            projection=['counts'],
+            return_document=pymongo.collection.ReturnDocument.AFTER)
+        if not entry:
+            assert interval > 0
+            return None
+    if interval > 0 and sum(entry['counts'].values()) == 1:
+        # The first request in a window must keep the interval from the last
+        # request in the previous window.
+        last_entry = _db.api_rate_limits.find_one(
+            {'_id': '%d:%s' % (
+                window_time - FLAGS.api_rate_limit_window_size, username)},
+            projection=['last_access_time'])
+        if last_entry and last_entry['last_access_time'] > now - interval:
+            _db.api_rate_limits.update_one({'_id': key}, {'$inc': {field: -1}})
+            return None
+    return entry['counts'][action]
+
+
+def increment_api_rate_limit_counter(username, action, amount, window_time):
+    """Adds requests to an API rate limit window.
+
+    This is used to merge request counts kept outside MongoDB.
 
     Args:
         username: Username.
         action: Action name.
+        amount: The number of requests to add.
+        window_time: Start time of the window.
 
     Returns:
-        An integer of the rate limit count after increment.
+        The number of requests of the action in the window after the update.
     """
-    last_window_time = misc_util.align_timestamp(
-        misc_util.time(), FLAGS.contest_start_time, FLAGS.api_rate_limit_window_size)
-    key = '%s:%d:%s' % (action, last_window_time, username)
+    _, expire_time = _get_api_rate_limit_window(window_time)
+    key = '%d:%s' % (window_time, username)
+    field = 'counts.%s' % action
+    update = {'$inc': {field: amount}}
     try:
         entry = _db.api_rate_limits.find_one_and_update(
             {'_id': key},
-            {
-                '$setOnInsert': {'_id': key},
-                '$inc': {'value': 1},
-            },
+            dict(update, **{
+                '$setOnInsert': {
+                    '_id': key,
+                    'expire_time': expire_time,
+                    'last_access_time': 0,
+                },
+            }),
+            projection=[field],
             upsert=True,
             return_document=pymongo.collection.ReturnDocument.AFTER)
     except pymongo.errors.DuplicateKeyError:
         entry = _db.api_rate_limits.find_one_and_update(
             {'_id': key},
-            {'$inc': {'value': 1}},
+            update,
+            projection=[field],
             return_document=pymongo.collection.ReturnDocument.AFTER)
-    return entry['value']
+    return entry['counts'][action]
 
 
 def decrement_web_rate_limit_counter(username):
@@ -391,9 +720,32 @@ def perform_health_checks():
     _increment_atomic_counter('test')
 
 
+def compute_blob_key(blob):
+    """Computes the key of a blob without saving it.
+
+    Args:
+        blob: A str.
+
+    Returns:
+        The blob key save_blob() would return for |blob|.
+    """
+    if isinstance(blob, unicode):
+        blob = blob.encode('ascii')
+    assert isinstance(blob, str)
+    return hashlib.sha1(blob).hexdigest()
+
+
+def _is_gzipped(data):
+    # Blobs are ASCII text, so they never start with the gzip magic number.
+    return data.startswith('\x1f\x8b')
+
+
 def save_blob(blob, mimetype):
     """Saves a blob in the large blob storage.
 
+    Blobs are stored gzip-compressed, so that load_gzipped_blob() can serve
+    them without recompression.
+
     Args:
         blob: A str.
         mimetype: MIME type.
@@ -403,24 +755,38 @@ def save_blob(blob, mimetype):
     """
     if isinstance(blob, unicode):
         blob = blob.encode('ascii')
-    assert isinstance(blob, str)
-    key = hashlib.sha1(blob).hexdigest()
+    key = compute_blob_key(blob)
     if FLAGS.storage_gcs_bucket_name:
         storage.save('blobs/%s' % key, blob, mimetype=mimetype)
+    elif FLAGS.storage_local_dir:
+        if not local_storage.exists(key):
+            local_storage.save(key, misc_util.gzip_compress(blob))
     else:
+        value = bson.binary.Binary(misc_util.gzip_compress(blob))
         try:
             _db.blobs.update_one(
                 {'_id': key},
-                {'$setOnInsert': {'_id': key, 'value': bson.binary.Binary(blob)}},
+                {'$setOnInsert': {'_id': key, 'value': value}},
                 upsert=True)
         except pymongo.errors.DuplicateKeyError:
             pass
     return key
 
 
+def _get_blob_cache():
+    global _blob_cache
+    with _blob_cache_lock:
+        if _blob_cache is None:
+            _blob_cache = misc_util.LRUCache(
+                max_bytes=FLAGS.blob_cache_max_bytes)
+        return _blob_cache
+
+
 def load_blob(key):
     """Loads a blob from the large blob storage.
 
+    Blobs are cached in the process memory up to --blob_cache_max_bytes.
+
     Args:
         key: A blob key.
 
@@ -430,8 +796,54 @@ def load_blob(key):
     Raises:
         KeyError: Blob entry was not found.
     """
+    data = _load_cached_blob_data(key)
+    if _is_gzipped(data):
+        return misc_util.gzip_decompress(data)
+    return data
+
+
+def load_gzipped_blob(key):
+    """Loads a blob from the large blob storage as gzip-compressed.
+
+    Blobs are cached in the process memory up to --blob_cache_max_bytes.
+
+    Args:
+        key: A blob key.
+
+    Returns:
+        str in the gzip format.
+
+    Raises:
+        KeyError: Blob entry was not found.
+    """
+    data = _load_cached_blob_data(key)
+    if not _is_gzipped(data):
+        return misc_util.gzip_compress(data)
+    return data
+
+
+def _load_cached_blob_data(key):
+    """Loads blob data as stored, through the cache.
+
+    Cache statistics are emitted as blob_cache events periodically.
+    """
+    if FLAGS.disable_model_cache_for_testing or FLAGS.blob_cache_max_bytes <= 0:
+        return _load_blob_data(key)
+    cache = _get_blob_cache()
+    data = cache.get(key)
+    if data is None:
+        data = _load_blob_data(key)
+        cache.put(key, data)
+    eventlog.emit_periodically('blob_cache', cache.get_stats)
+    return data
+
+
+def _load_blob_data(key):
+    """Loads blob data as stored, which may be gzip-compressed."""
     if FLAGS.storage_gcs_bucket_name:
         return storage.load('blobs/%s' % key)
+    elif FLAGS.storage_local_dir:
+        return local_storage.load(key)
     else:
         entry = _db.blobs.find_one({'_id': key})
         if not entry:
@@ -439,6 +851,47 @@ def load_blob(key):
         return str(entry['value'])
 
 
+def migrate_blobs_to_local_storage():
+    """Copies blobs stored in the database to the local storage.
+
+    Blobs already in the local storage are skipped, so this can be resumed
+    after interruption. Entries in the database are left untouched.
+
+    Returns:
+        (copied, skipped)
+    """
+    assert FLAGS.storage_local_dir and not FLAGS.storage_gcs_bucket_name
+    copied = skipped = 0
+    last_key = None
+    while True:
+        # Page by _id with short-lived cursors, so that a long migration does
+        # not hit cursor timeouts.
+        query = {} if last_key is None else {'_id': {'$gt': last_key}}
+        keys = [
+            entry['_id'] for entry in _db.blobs.find(
+                query,
+                projection=['_id'],
+                sort=[('_id', pymongo.ASCENDING)],
+                limit=1000)]
+        if not keys:
+            break
+        last_key = keys[-1]
+        for key in keys:
+            if local_storage.exists(key):
+                skipped += 1
+                continue
+            # Fetch values one by one to keep the memory usage low.
+            entry = _db.blobs.find_one({'_id': key})
+            value = str(entry['value'])
+            if not _is_gzipped(value):
+                value = misc_util.gzip_compress(value)
+            local_storage.save(key, value)
+            copied += 1
+            if copied % 1000 == 0:
+                logging.info('Copied %d blobs', copied)
+    return (copied, skipped)
+
+
 def get_signed_blob_url(key):
     """Returns an external URL serving the blob.
 
@@ -453,6 +906,50 @@ def get_signed_blob_url(key):
     return storage.get_signed_url('blobs/%s' % key)
 
 
+def get_cached_evaluation(problem_spec_hash, solution_spec_hash):
+    """Looks up a cached judge result.
+
+    Args:
+        problem_spec_hash: Problem specification hash string.
+        solution_spec_hash: Normalized solution specification hash string.
+
+    Returns:
+        (resemblance_int, processing_time), or None if it is not cached.
+    """
+    entry = _db.evaluation_cache.find_one(
+        {'_id': '%s:%s' % (problem_spec_hash, solution_spec_hash)})
+    # Entries cached by old versions lack processing_time; judge them again.
+    if not entry or 'processing_time' not in entry:
+        return None
+    return (entry['resemblance_int'], entry['processing_time'])
+
+
+def set_cached_evaluation(
+        problem_spec_hash, solution_spec_hash, resemblance_int,
+        processing_time):
+    """Caches a judge result.
+
+    Args:
+        problem_spec_hash: Problem specification hash string.
+        solution_spec_hash: Normalized solution specification hash string.
+        resemblance_int: Resemblance value as an integer.
+        processing_time: Time in seconds it took to judge the solution.
+    """
+    key = '%s:%s' % (problem_spec_hash, solution_spec_hash)
+    try:
+        _db.evaluation_cache.update_one(
+            {'_id': key, 'processing_time': {'$exists': False}},
+            {
+                '$set': {
+                    'resemblance_int': resemblance_int,
+                    'processing_time': processing_time,
+                },
+            },
+            upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+        pass
+
+
 def register_user(display_name, contact_email, member_names, nationalities, languages, source_url, remote_host):
     """Registers a new user.
 
@@ -524,13 +1021,50 @@ def update_user(
         update['source_url'] = source_url
     if update:
         _db.users.update_one({'_id': username}, {'$set': update})
+        # Other processes see the update after --user_cache_ttl.
+        _get_user_cache().delete(('username', username))
+
+
+def _get_user_cache():
+    global _user_cache
+    with _user_cache_lock:
+        if _user_cache is None:
+            _user_cache = misc_util.LRUCache(
+                max_entries=FLAGS.user_cache_max_entries)
+        return _user_cache
+
+
+def _use_user_cache(use_cache):
+    return (use_cache and FLAGS.user_cache_ttl > 0 and
+            not FLAGS.disable_model_cache_for_testing)
 
 
-def get_user(username):
+def _get_cached_user(username):
+    entry = _get_user_cache().get(('username', username))
+    if entry is None:
+        return None
+    user, expire_time = entry
+    if misc_util.time() >= expire_time:
+        return None
+    return user
+
+
+def _put_cached_user(user):
+    cache = _get_user_cache()
+    cache.put(
+        ('username', user['_id']),
+        (user, misc_util.time() + FLAGS.user_cache_ttl))
+    cache.put(('api_key', user['api_key']), user['_id'])
+
+
+def get_user(username, use_cache=False):
     """Returns the specified user.
 
     Args:
         username: The username.
+        use_cache: If true, the user may be returned from the process-local
+            cache, which is up to --user_cache_ttl seconds old. The returned
+            dictionary is shared and must not be modified.
 
     Returns:
         A user dictionary.
@@ -538,9 +1072,16 @@ def get_user(username):
     Raises:
         KeyError: If the specified user is not found.
     """
+    use_cache = _use_user_cache(use_cache)
+    if use_cache:
+        user = _get_cached_user(username)
+        if user is not None:
+            return user
     user = _db.users.find_one({'_id': username})
     if not user:
         raise KeyError('User not found: %s' % username)
+    if use_cache:
+        _put_cached_user(user)
     return user
 
 
@@ -583,29 +1124,31 @@ def get_user_solutions(username):
     user = _db.users.find_one({'_id': username})
     if not user:
         raise KeyError('User not found: %s' % username)
-    solutions = _db.solutions.find(
+    # Select the best (and oldest) solution for each problem.
+    cursor = _db.solutions.aggregate([
+        {'$match': {'owner': user['_id']}},
+        {'$sort': collections.OrderedDict([
+            ('problem_id', pymongo.ASCENDING),
+            ('resemblance_int', pymongo.DESCENDING),
+            ('_id', pymongo.ASCENDING),
+        ])},
+        {'$group': {
+            '_id': '$problem_id',
+            'solution_id': {'$first': '$_id'},
+            'resemblance_int': {'$first': '$resemblance_int'},
+            'solution_size': {'$first': '$solution_size'},
+        }},
+        {'$sort': {'_id': pymongo.ASCENDING}},
+    ], allowDiskUse=True)
+    return [
         {
-            'owner': user['_id']
-        },
-        projection=('resemblance_int', 'solution_size', 'problem_id', '_id'))
-
-    # manually select the best (and oldest) solution
-    table = {}
-    for solution in solutions:
-        problem_id = solution['problem_id']
-        if problem_id in table:
-            old_solution = table[problem_id]
-            if solution['resemblance_int'] > old_solution['resemblance_int'] or \
-                (solution['resemblance_int'] == old_solution['resemblance_int'] and solution['_id'] < old_solution['_id']):
-                table[problem_id] = solution
-        else:
-            table[problem_id] = solution
-
-    # sort by problem_id
-    solutions = table.values()
-    solutions.sort(key=lambda solution: solution['problem_id'])
-
-    return solutions
+            '_id': entry['solution_id'],
+            'problem_id': entry['_id'],
+            'resemblance_int': entry['resemblance_int'],
+            'solution_size': entry['solution_size'],
+        }
+        for entry in cursor
+    ]
 
 
 def get_user_map(usernames):
@@ -621,11 +1164,14 @@ def get_user_map(usernames):
     return {user['_id']: user for user in users}
 
 
-def get_user_by_api_key(api_key):
+def get_user_by_api_key(api_key, use_cache=False):
     """Looks up a user by an API key.
 
     Args:
         api_key: API key.
+        use_cache: If true, the user may be returned from the process-local
+            cache, which is up to --user_cache_ttl seconds old. The returned
+            dictionary is shared and must not be modified.
 
     Returns:
         A user dictionary.
@@ -635,9 +1181,19 @@ def get_user_by_api_key(api_key):
     """
     if not api_key:
         raise KeyError('User not found by API key')
+    use_cache = _use_user_cache(use_cache)
+    if use_cache:
+        # API keys never change, so only users expire.
+        username = _get_user_cache().get(('api_key', api_key))
+        if username is not None:
+            user = _get_cached_user(username)
+            if user is not None:
+                return user
     user = _db.users.find_one({'api_key': api_key})
     if not user:
         raise KeyError('User not found by API key')
+    if use_cache:
+        _put_cached_user(user)
     return user
 
 
@@ -659,7 +1215,8 @@ def get_all_users(**options):
 
 def enqueue_problem(
         owner, problem_spec, problem_size, solution_spec, solution_size,
-        create_time, publish_time, processing_time, publish_immediately):
+        create_time, publish_time, processing_time, publish_immediately,
+        problem_id=None):
     """Registers a new problem.
 
     Args:
@@ -673,6 +1230,9 @@ def enqueue_problem(
         processing_time: Processing time in seconds.
         publish_immediately: Set to True if this problem should be marked
             public immediately.
+        problem_id: Numeric ID reserved by reserve_judge_job_registered_id().
+            If a problem with the ID already exists, it is returned instead.
+            If None, a new ID is allocated.
 
     Returns:
         A newly created problem dictionary.
@@ -680,8 +1240,10 @@ def enqueue_problem(
     assert isinstance(publish_time, int)
     problem_spec_hash = save_blob(problem_spec, mimetype='text/plain')
     solution_spec_hash = save_blob(solution_spec, mimetype='text/plain')
+    if problem_id is None:
+        problem_id = _allocate_id('problem_counter')
     new_problem = {
-        '_id': _increment_atomic_counter('problem_counter'),
+        '_id': problem_id,
         'create_time': create_time,
         'owner': owner,
         'problem_spec_hash': problem_spec_hash,
@@ -691,25 +1253,32 @@ def enqueue_problem(
         'public': publish_immediately,
         'publish_time': publish_time,
         'processing_time': processing_time,
+        'last_solution_time': 0,
     }
-    _db.problems.insert_one(new_problem)
+    try:
+        _db.problems.insert_one(new_problem)
+    except pymongo.errors.DuplicateKeyError:
+        # Registered by another runner of the same judge job.
+        return _db.problems.find_one({'_id': problem_id})
+    _add_to_count('problem_count')
+    if publish_immediately:
+        _add_to_count('public_problem_count')
     return new_problem
 
 
-def get_public_problems(**options):
+def get_public_problems(after=None, before=None, **options):
     """Returns the list of all public problems present in the database.
 
     Args:
+        after: If set, only problems with greater IDs are returned.
+        before: If set, only problems with less IDs are returned. If after is
+            not set, problems with the closest IDs are returned.
         **options: Options passed to query.
 
     Returns:
-        A list of problem dictionaries.
+        A list of problem dictionaries sorted by ID.
     """
-    cursor = _db.problems.find(
-        {'public': True},
-        sort=[('_id', pymongo.ASCENDING)],
-        **options)
-    return list(cursor)
+    return _find_page(_db.problems, {'public': True}, after, before, options)
 
 
 def count_public_problems():
@@ -718,10 +1287,7 @@ def count_public_problems():
     Returns:
         Count of all public problems.
     """
-    cursor = _db.problems.find(
-        {'public': True},
-        sort=[('_id', pymongo.DESCENDING)])
-    return cursor.count()
+    return _get_atomic_counter('public_problem_count')
 
 
 def get_public_problem(problem_id):
@@ -749,23 +1315,22 @@ def count_all_problems_for_admin():
     Returns:
         The count.
     """
-    return _db.problems.find({}).count()
+    return _get_atomic_counter('problem_count')
 
 
-def get_all_problems_for_admin(**options):
+def get_all_problems_for_admin(after=None, before=None, **options):
     """Returns all problems.
 
     Args:
+        after: If set, only problems with greater IDs are returned.
+        before: If set, only problems with less IDs are returned. If after is
+            not set, problems with the closest IDs are returned.
         **options: Options passed to query.
 
     Returns:
-        A list of problem dictionaries.
+        A list of problem dictionaries sorted by ID.
     """
-    cursor = _db.problems.find(
-        {},
-        sort=[('_id', pymongo.ASCENDING)],
-        **options)
-    problems = list(cursor)
+    problems = _find_page(_db.problems, {}, after, before, options)
     enhance_problems_for_admin(problems)
     return problems
 
@@ -790,7 +1355,7 @@ def get_problem_for_admin(problem_id):
 
 def register_solution(
         owner, problem_id, problem_spec_hash, solution_spec, solution_size,
-        resemblance_int, processing_time):
+        resemblance_int, processing_time, create_time=None, solution_id=None):
     """Registers a new solution.
 
     Args:
@@ -801,14 +1366,23 @@ def register_solution(
         solution_size: Solution size.
         resemblance_int: Resemblance value as an integer.
         processing_time: Processing time in seconds.
+        create_time: Timestamp when this solution is submitted. If None, the
+            current time is used.
+        solution_id: Numeric ID reserved by reserve_judge_job_registered_id().
+            If a solution with the ID already exists, it is returned instead.
+            If None, a new ID is allocated.
 
     Returns:
         A newly created solution dictionary.
     """
     solution_spec_hash = save_blob(solution_spec, mimetype='text/plain')
+    if create_time is None:
+        create_time = misc_util.time()
+    if solution_id is None:
+        solution_id = _allocate_id('solution_counter')
     new_solution = {
-        '_id': _increment_atomic_counter('solution_counter'),
-        'create_time': misc_util.time(),
+        '_id': solution_id,
+        'create_time': create_time,
         'owner': owner,
         'problem_id': problem_id,
         'problem_spec_hash': problem_spec_hash,
@@ -817,7 +1391,16 @@ def register_solution(
         'resemblance_int': resemblance_int,
         'processing_time': processing_time,
     }
-    _db.solutions.insert_one(new_solution)
+    try:
+        _db.solutions.insert_one(new_solution)
+    except pymongo.errors.DuplicateKeyError:
+        # Registered by another runner of the same judge job.
+        return _db.solutions.find_one({'_id': solution_id})
+    _add_to_count('solution_count', batch=True)
+    # Mark the problem dirty for update_problem_ranking_snapshots().
+    _db.problems.update_one(
+        {'_id': problem_id},
+        {'$max': {'last_solution_time': new_solution['create_time']}})
     return new_solution
 
 
@@ -827,23 +1410,22 @@ def count_all_solutions_for_admin():
     Returns:
         The count.
     """
-    return _db.solutions.find({}).count()
+    return _get_atomic_counter('solution_count')
 
 
-def get_all_solutions_for_admin(**options):
+def get_all_solutions_for_admin(after=None, before=None, **options):
     """Returns all solutions.
 
     Args:
+        after: If set, only solutions with greater IDs are returned.
+        before: If set, only solutions with less IDs are returned. If after
+            is not set, solutions with the closest IDs are returned.
         **options: Options passed to query.
 
     Returns:
-        A list of solution dictionaries.
+        A list of solution dictionaries sorted by ID.
     """
-    cursor = _db.solutions.find(
-        {},
-        sort=[('_id', pymongo.ASCENDING)],
-        **options)
-    return list(cursor)
+    return _find_page(_db.solutions, {}, after, before, options)
 
 
 def get_solution_for_admin(solution_id):
@@ -865,6 +1447,144 @@ def get_solution_for_admin(solution_id):
     return solution
 
 
+def enqueue_judge_job(kind, owner, params):
+    """Enqueues a submission to be judged asynchronously.
+
+    Args:
+        kind: 'solution' or 'problem'.
+        owner: Owner username.
+        params: Dictionary of submission parameters.
+
+    Returns:
+        A newly created job dictionary.
+    """
+    assert kind in ('solution', 'problem')
+    new_job = {
+        '_id': misc_util.generate_random_id(32),
+        'kind': kind,
+        'owner': owner,
+        'params': params,
+        'status': 'pending',
+        'create_time': misc_util.time(),
+    }
+    _db.judge_jobs.insert_one(new_job)
+    return new_job
+
+
+def claim_judge_job(stale_time):
+    """Claims the oldest pending judge job.
+
+    Args:
+        stale_time: Timestamp. Running jobs claimed before this timestamp are
+            considered abandoned and may be claimed again.
+
+    Returns:
+        A job dictionary, or None if there is no job to run.
+    """
+    return _db.judge_jobs.find_one_and_update(
+        {
+            '$or': [
+                {'status': 'pending'},
+                {'status': 'running', 'claim_time': {'$lt': stale_time}},
+            ],
+        },
+        {'$set': {'status': 'running', 'claim_time': misc_util.time()}},
+        sort=[('create_time', pymongo.ASCENDING)],
+        return_document=pymongo.collection.ReturnDocument.AFTER)
+
+
+def reserve_judge_job_registered_id(job):
+    """Returns the ID of the problem or solution registered by a judge job.
+
+    The ID is recorded in the job before registration, so that a runner which
+    claims the job again after a crash registers under the same ID instead of
+    registering another problem or solution.
+
+    Args:
+        job: A job dictionary returned by claim_judge_job().
+
+    Returns:
+        A numeric problem ID or solution ID.
+    """
+    if 'registered_id' in job:
+        return job['registered_id']
+    registered_id = _allocate_id('%s_counter' % job['kind'])
+    updated_job = _db.judge_jobs.find_one_and_update(
+        {'_id': job['_id'], 'registered_id': {'$exists': False}},
+        {'$set': {'registered_id': registered_id}},
+        return_document=pymongo.collection.ReturnDocument.AFTER)
+    if not updated_job:
+        # Another runner reserved an ID first; the allocated ID is skipped.
+        updated_job = _db.judge_jobs.find_one({'_id': job['_id']})
+    job['registered_id'] = updated_job['registered_id']
+    return job['registered_id']
+
+
+def finish_judge_job(job_id, claim_time, result=None, error=None):
+    """Records the outcome of a judge job.
+
+    Nothing is recorded if the job has been claimed again by another runner
+    since, or has already been finished.
+
+    Args:
+        job_id: Job ID.
+        claim_time: claim_time of the job dictionary returned by
+            claim_judge_job().
+        result: Dictionary of the result if the job succeeded.
+        error: Error message if the job failed.
+
+    Returns:
+        True if the outcome was recorded.
+    """
+    assert (result is None) != (error is None)
+    update = {
+        'status': 'done' if error is None else 'failed',
+        'finish_time': misc_util.time(),
+    }
+    if error is None:
+        update['result'] = result
+    else:
+        update['error'] = error
+    res = _db.judge_jobs.update_one(
+        {'_id': job_id, 'status': 'running', 'claim_time': claim_time},
+        {'$set': update})
+    return res.matched_count > 0
+
+
+def get_judge_job(job_id, owner):
+    """Returns a judge job.
+
+    Args:
+        job_id: Job ID.
+        owner: Username of the job owner.
+
+    Returns:
+        A job dictionary.
+
+    Raises:
+        KeyError: If the specified job was not found, or it is not owned by
+            the user.
+    """
+    job = _db.judge_jobs.find_one({'_id': job_id, 'owner': owner})
+    if not job:
+        raise KeyError('Job not found: %s' % job_id)
+    return job
+
+
+def abandon_judge_job_for_testing(job_id):
+    """Makes a judge job look claimed long ago by a crashed runner.
+
+    Args:
+        job_id: Job ID.
+    """
+    _db.judge_jobs.update_one(
+        {'_id': job_id},
+        {
+            '$set': {'status': 'running', 'claim_time': 0},
+            '$unset': {'result': '', 'error': '', 'finish_time': ''},
+        })
+
+
 def publish_scheduled_problems():
     """Publishes scheduled problems."""
     last_published_problem = _db.problems.find_one(
@@ -877,7 +1597,9 @@ def publish_scheduled_problems():
         {
             'publish_time': {'$lte': misc_util.time(), '$gt': last_publish_time},
         },
-        sort=[('_id', pymongo.DESCENDING)],
+        # Sort by creation time since IDs may be out of order with
+        # --id_block_size.
+        sort=[('create_time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
         projection=('owner', 'publish_time', '_id', 'public'))
     publishing_problem_ids = []
     publishing_pairs = set()
@@ -889,14 +1611,18 @@ def publish_scheduled_problems():
             publishing_pairs.add(pair)
             publishing_problem_ids.append(problem['_id'])
     if publishing_problem_ids:
-        _db.problems.update_many(
-            {'_id': {'$in': publishing_problem_ids}},
+        result = _db.problems.update_many(
+            {'_id': {'$in': publishing_problem_ids}, 'public': False},
             {'$set': {'public': True}})
+        if result.modified_count:
+            _add_to_count('public_problem_count', result.modified_count)
 
 
 def get_last_problem_ranking_snapshot(problem_id, public_only):
     """Returns the last problem ranking snapshot.
 
+    Snapshots are cached in the process memory until a newer one is found.
+
     Args:
         problem_id: Numeric ID of the problem.
         public_only: If true, only public snapshots are considered.
@@ -914,16 +1640,71 @@ def get_last_problem_ranking_snapshot(problem_id, public_only):
     }
     if public_only:
         query['public'] = True
-    snapshot = _db.problem_ranking_snapshots.find_one(
-        query,
-        sort=[('snapshot_time', pymongo.DESCENDING)])
-    if not snapshot:
-        return (FLAGS.contest_start_time, [])
-    return (snapshot['snapshot_time'], snapshot['ranking'])
 
+    def get_snapshot_time():
+        snapshot = _db.problem_ranking_snapshots.find_one(
+            query,
+            projection=['snapshot_time'],
+            sort=[('snapshot_time', pymongo.DESCENDING)])
+        if not snapshot:
+            return FLAGS.contest_start_time
+        return snapshot['snapshot_time']
 
-def _update_problem_ranking_snapshot(snapshot_time, problem_id):
-    assert settings.is_secondary_snapshot_time(snapshot_time)
+    def load_snapshot():
+        snapshot = _db.problem_ranking_snapshots.find_one(
+            query,
+            sort=[('snapshot_time', pymongo.DESCENDING)])
+        if not snapshot:
+            return (FLAGS.contest_start_time, [])
+        _resolve_problem_ranking_snapshots([snapshot])
+        return (snapshot['snapshot_time'], snapshot['ranking'])
+
+    return _get_cached_snapshot(
+        ('problem_ranking', problem_id, public_only),
+        get_snapshot_time, load_snapshot)
+
+
+def _resolve_problem_ranking_snapshots(snapshots):
+    """Fills in problem ranking snapshots carried forward by reference.
+
+    Snapshots of problems without new solutions do not hold the ranking by
+    themselves, but refer to the last snapshot with it by base_id.
+
+    Args:
+        snapshots: A list of problem ranking snapshot dictionaries. They are
+            updated in place.
+    """
+    base_ids = list(set(
+        snapshot['base_id'] for snapshot in snapshots if 'base_id' in snapshot))
+    if not base_ids:
+        return
+    cursor = _db.problem_ranking_snapshots.find({'_id': {'$in': base_ids}})
+    base_map = {base['_id']: base for base in cursor}
+    for snapshot in snapshots:
+        if 'base_id' in snapshot:
+            base = base_map[snapshot['base_id']]
+            for field in ('problem', 'ranking', 'team_scores'):
+                if field in base:
+                    snapshot[field] = base[field]
+
+
+def _iter_resolved_problem_ranking_snapshots(cursor):
+    """Iterates over problem ranking snapshots, filling in references."""
+    while True:
+        snapshots = list(itertools.islice(cursor, 1000))
+        if not snapshots:
+            break
+        _resolve_problem_ranking_snapshots(snapshots)
+        for snapshot in snapshots:
+            yield snapshot
+
+
+def _find_last_problem_ranking_snapshot(snapshot_time, problem_id):
+    """Returns the last problem ranking snapshot at or before |snapshot_time|.
+
+    If the problem has no snapshot yet, a pseudo snapshot with an empty
+    ranking and problem_id set to None is returned.
+    """
     last_snapshot = _db.problem_ranking_snapshots.find_one(
         {
             'problem_id': problem_id,
@@ -932,28 +1713,58 @@ def _update_problem_ranking_snapshot(snapshot_time, problem_id):
         sort=[('snapshot_time', pymongo.DESCENDING)])
     if not last_snapshot:
         problem = _db.problems.find_one({'_id': problem_id})
-        last_snapshot = {
+        return {
             'problem_id': None,
             'snapshot_time': 0,
             'problem': problem,
             'ranking': [],
         }
-    if last_snapshot['snapshot_time'] == snapshot_time:
-        return
+    _resolve_problem_ranking_snapshots([last_snapshot])
+    return last_snapshot
+
+
+def _find_last_problem_ranking_snapshots(snapshot_time, problem_ids):
+    """Batched version of _find_last_problem_ranking_snapshot().
+
+    Returns:
+        A dictionary mapping problem IDs to snapshot dictionaries.
+    """
+    last_snapshot_time = snapshot_time - FLAGS.contest_secondary_snapshot_interval
+    # Most problems have a snapshot at the previous secondary snapshot time.
+    cursor = _db.problem_ranking_snapshots.find(
+        {
+            '_id': {
+                '$in': ['%d:%d' % (problem_id, last_snapshot_time)
+                        for problem_id in problem_ids],
+            },
+        })
+    last_snapshot_map = {
+        last_snapshot['problem_id']: last_snapshot
+        for last_snapshot in _iter_resolved_problem_ranking_snapshots(cursor)
+    }
+    for problem_id in problem_ids:
+        if problem_id not in last_snapshot_map:
+            last_snapshot_map[problem_id] = _find_last_problem_ranking_snapshot(
+                snapshot_time, problem_id)
+    return last_snapshot_map
+
+
+def _compute_problem_ranking(last_ranking, solutions):
+    """Computes a problem ranking by merging new solutions to the last one.
+
+    Args:
+        last_ranking: The ranking of the last snapshot.
+        solutions: An iterable of solution dictionaries newer than the last
+            snapshot, in the order of submission.
+
+    Returns:
+        A new ranking.
+    """
     owner_to_entry = {
         entry['owner']: entry
-        for entry in last_snapshot['ranking']
+        for entry in last_ranking
     }
-    cursor = _db.solutions.find(
-        {
-            'problem_id': problem_id,
-            'create_time': {
-                '$lt': snapshot_time,
-                '$gte': last_snapshot['snapshot_time'],
-            },
-        },
-        projection=('_id', 'owner', 'resemblance_int', 'solution_size'))
-    for solution in cursor:
+    for solution in solutions:
         last_entry = owner_to_entry.get(
             solution['owner'], {'resemblance_int': -1})
         if (solution['resemblance_int'] > last_entry['resemblance_int'] or
@@ -968,33 +1779,315 @@ def _update_problem_ranking_snapshot(snapshot_time, problem_id):
     ranking = owner_to_entry.values()
     ranking.sort(key=lambda entry: (
         -entry['resemblance_int'], entry['solution_size'], entry['solution_id']))
-    key = '%d:%d' % (problem_id, snapshot_time)
+    return ranking
+
+
+def _make_problem_ranking_snapshot(snapshot_time, last_snapshot, ranking):
+    """Returns a problem ranking snapshot following |last_snapshot|.
+
+    Returns:
+        A problem ranking snapshot dictionary.
+    """
+    problem = last_snapshot['problem']
+    # Snapshots not marked as changed have the same ranking as the previous
+    # one, so update_leaderboard_snapshot() can skip them.
+    changed = (last_snapshot['problem_id'] is None or
+               ranking != last_snapshot['ranking'])
+    team_scores = scoring.compute_team_scores_for_problem(problem, ranking)
     public = settings.is_public_problem_ranking_snapshot_time(snapshot_time)
-    try:
-        _db.problem_ranking_snapshots.update_one(
-            {'_id': key},
+    solution_count, perfect_solution_count = _count_ranked_solutions(ranking)
+    return {
+        '_id': '%d:%d' % (problem['_id'], snapshot_time),
+        'problem_id': problem['_id'],
+        'snapshot_time': snapshot_time,
+        'problem': problem,
+        'ranking': ranking,
+        'team_scores': team_scores,
+        'solution_count': solution_count,
+        'perfect_solution_count': perfect_solution_count,
+        'changed': changed,
+        'public': public,
+    }
+
+
+def _count_ranked_solutions(ranking):
+    """Counts solutions in a problem ranking.
+
+    Returns:
+        (solution_count, perfect_solution_count)
+    """
+    perfect_solution_count = 0
+    for solution in ranking:
+        if solution['resemblance_int'] == 1000000:
+            perfect_solution_count += 1
+    return (len(ranking), perfect_solution_count)
+
+
+def _make_snapshot_upsert(snapshot):
+    """Returns an upsert operation writing a snapshot dictionary.
+
+    Returns:
+        pymongo.UpdateOne instance.
+    """
+    fields = snapshot.copy()
+    key = fields.pop('_id')
+    return pymongo.UpdateOne(
+        {'_id': key},
+        {
+            '$setOnInsert': {'_id': key},
+            '$set': fields,
+        },
+        upsert=True)
+
+
+def _bulk_write_snapshots(collection, requests):
+    """Writes snapshots with unordered bulk writes.
+
+    Requests are sent in batches of --snapshot_write_batch_size, each
+    reported as a snapshot_write event. Inserts conflicting with snapshots
+    already written by a previous run are ignored.
+
+    Args:
+        collection: pymongo.collection.Collection instance.
+        requests: An iterable of pymongo write operations. It is consumed
+            lazily, batch by batch.
+    """
+    requests = iter(requests)
+    while True:
+        batch = list(itertools.islice(requests, FLAGS.snapshot_write_batch_size))
+        if not batch:
+            break
+        with eventlog.record_time(
+                'snapshot_write',
+                {'collection': collection.name, 'requests': len(batch)}):
+            try:
+                collection.bulk_write(batch, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                if any(error['code'] != 11000
+                       for error in e.details['writeErrors']):
+                    raise
+
+
+def _compute_problem_ranking_snapshot(snapshot_time, problem_id):
+    """Computes the problem ranking snapshot of a problem.
+
+    Returns:
+        A problem ranking snapshot dictionary, or None if the snapshot
+        already exists.
+    """
+    assert settings.is_secondary_snapshot_time(snapshot_time)
+    last_snapshot = _find_last_problem_ranking_snapshot(snapshot_time, problem_id)
+    if last_snapshot['snapshot_time'] == snapshot_time:
+        return None
+    cursor = _db.solutions.find(
+        {
+            'problem_id': problem_id,
+            'create_time': {
+                '$lt': snapshot_time,
+                '$gte': last_snapshot['snapshot_time'],
+            },
+        },
+        projection=('_id', 'owner', 'resemblance_int', 'solution_size'))
+    ranking = _compute_problem_ranking(last_snapshot['ranking'], cursor)
+    return _make_problem_ranking_snapshot(snapshot_time, last_snapshot, ranking)
+
+
+def _compute_problem_ranking_snapshots_by_aggregation(
+        snapshot_time, problem_ids):
+    """Computes problem ranking snapshots of multiple problems at once.
+
+    New solutions of all the problems are reduced to the best one per
+    (problem_id, owner) by a single aggregation.
+
+    Returns:
+        A list of problem ranking snapshot dictionaries.
+    """
+    assert settings.is_secondary_snapshot_time(snapshot_time)
+    if not problem_ids:
+        return []
+    last_snapshot_map = _find_last_problem_ranking_snapshots(
+        snapshot_time, problem_ids)
+    time_to_problem_ids = collections.defaultdict(list)
+    for problem_id, last_snapshot in last_snapshot_map.iteritems():
+        if last_snapshot['snapshot_time'] != snapshot_time:
+            time_to_problem_ids[last_snapshot['snapshot_time']].append(problem_id)
+    if not time_to_problem_ids:
+        return []
+    # Solutions with the same resemblance and size are ordered by _id so that
+    # the earliest one wins, as in _compute_problem_ranking().
+    cursor = _db.solutions.aggregate(
+        [
             {
-                '$setOnInsert': {'_id': key},
-                '$set': {
-                    'problem_id': problem_id,
-                    'snapshot_time': snapshot_time,
-                    'problem': last_snapshot['problem'],
-                    'ranking': ranking,
-                    'public': public,
+                '$match': {
+                    '$or': [
+                        {
+                            'problem_id': {'$in': time_problem_ids},
+                            'create_time': {
+                                '$lt': snapshot_time,
+                                '$gte': last_snapshot_time,
+                            },
+                        }
+                        for last_snapshot_time, time_problem_ids
+                        in time_to_problem_ids.iteritems()
+                    ],
                 },
             },
-            upsert=True)
-    except pymongo.errors.DuplicateKeyError:
-        pass
+            {
+                '$sort': collections.OrderedDict([
+                    ('resemblance_int', pymongo.DESCENDING),
+                    ('solution_size', pymongo.ASCENDING),
+                    ('_id', pymongo.ASCENDING),
+                ]),
+            },
+            {
+                '$group': {
+                    '_id': {'problem_id': '$problem_id', 'owner': '$owner'},
+                    'solution_id': {'$first': '$_id'},
+                    'resemblance_int': {'$first': '$resemblance_int'},
+                    'solution_size': {'$first': '$solution_size'},
+                },
+            },
+        ],
+        allowDiskUse=True)
+    problem_to_solutions = collections.defaultdict(list)
+    for group in cursor:
+        problem_to_solutions[group['_id']['problem_id']].append({
+            '_id': group['solution_id'],
+            'owner': group['_id']['owner'],
+            'resemblance_int': group['resemblance_int'],
+            'solution_size': group['solution_size'],
+        })
+    snapshots = []
+    for time_problem_ids in time_to_problem_ids.itervalues():
+        for problem_id in time_problem_ids:
+            last_snapshot = last_snapshot_map[problem_id]
+            ranking = _compute_problem_ranking(
+                last_snapshot['ranking'], problem_to_solutions[problem_id])
+            snapshots.append(_make_problem_ranking_snapshot(
+                snapshot_time, last_snapshot, ranking))
+    return snapshots
+
+
+def _compute_problem_ranking_snapshots_serially(snapshot_time, problem_ids):
+    """Computes problem ranking snapshots of problems in the current thread.
+
+    Returns:
+        An iterable of problem ranking snapshot dictionaries.
+    """
+    if FLAGS.ranking_snapshot_builder == 'aggregation':
+        return _compute_problem_ranking_snapshots_by_aggregation(
+            snapshot_time, problem_ids)
+    snapshots = (
+        _compute_problem_ranking_snapshot(snapshot_time, problem_id)
+        for problem_id in problem_ids)
+    return (snapshot for snapshot in snapshots if snapshot is not None)
+
+
+def _compute_problem_ranking_snapshots(snapshot_time, problem_ids, num_workers):
+    """Computes problem ranking snapshots of problems.
+
+    If |num_workers| > 1, problems are sharded among a thread pool and this
+    returns after all shards are computed.
+
+    Returns:
+        An iterable of problem ranking snapshot dictionaries.
+    """
+    num_workers = min(num_workers, len(problem_ids))
+    if num_workers <= 1:
+        return _compute_problem_ranking_snapshots_serially(
+            snapshot_time, problem_ids)
+    shards = [problem_ids[i::num_workers] for i in xrange(num_workers)]
+    pool = multiprocessing.pool.ThreadPool(num_workers)
+    try:
+        results = pool.map(
+            lambda shard: list(_compute_problem_ranking_snapshots_serially(
+                snapshot_time, shard)),
+            shards)
+    finally:
+        pool.close()
+        pool.join()
+    return itertools.chain.from_iterable(results)
 
 
 def update_problem_ranking_snapshots(snapshot_time):
     """Updates problem rankings.
 
+    Rankings are recomputed only for problems which received solutions since
+    the previous secondary snapshot (see register_solution()). Snapshots of
+    other problems refer to the last snapshot holding their ranking instead
+    of copying it. Snapshots are written by batched bulk writes.
+
     Args:
         snapshot_time: Timestamp of the snapshot.
     """
     assert settings.is_secondary_snapshot_time(snapshot_time)
+    last_snapshot_time = snapshot_time - FLAGS.contest_secondary_snapshot_interval
+    cursor = _db.problems.find(
+        {
+            'public': True,
+            'publish_time': {'$lte': snapshot_time},
+        },
+        projection=['_id', 'publish_time', 'last_solution_time'])
+    problems = list(cursor)
+    cursor = _db.problem_ranking_snapshots.find(
+        {'snapshot_time': last_snapshot_time},
+        projection=[
+            '_id', 'problem_id', 'base_id',
+            'solution_count', 'perfect_solution_count'])
+    last_snapshot_map = {
+        last_snapshot['problem_id']: last_snapshot
+        for last_snapshot in cursor
+    }
+    public = settings.is_public_problem_ranking_snapshot_time(snapshot_time)
+    dirty_problem_ids = []
+    carried_snapshots = []
+    for problem in problems:
+        last_snapshot = last_snapshot_map.get(problem['_id'])
+        # Problems published at the last snapshot are updated as well, so that
+        # update_leaderboard_snapshot() notices they start counting.
+        if (last_snapshot is None or
+                problem.get('last_solution_time', last_snapshot_time) >=
+                last_snapshot_time or
+                problem['publish_time'] == last_snapshot_time):
+            dirty_problem_ids.append(problem['_id'])
+        else:
+            carried_snapshot = {
+                '_id': '%d:%d' % (problem['_id'], snapshot_time),
+                'problem_id': problem['_id'],
+                'snapshot_time': snapshot_time,
+                'base_id': last_snapshot.get('base_id', last_snapshot['_id']),
+                'changed': False,
+                'public': public,
+            }
+            # Snapshots written by old versions lack counts.
+            for field in ('solution_count', 'perfect_solution_count'):
+                if field in last_snapshot:
+                    carried_snapshot[field] = last_snapshot[field]
+            carried_snapshots.append(pymongo.InsertOne(carried_snapshot))
+    snapshots = _compute_problem_ranking_snapshots(
+        snapshot_time, dirty_problem_ids, FLAGS.snapshot_workers)
+    _bulk_write_snapshots(
+        _db.problem_ranking_snapshots,
+        itertools.chain(
+            (_make_snapshot_upsert(snapshot) for snapshot in snapshots),
+            carried_snapshots))
+
+
+def compute_problem_ranking_snapshots_for_testing(snapshot_time, num_workers):
+    """Computes problem ranking snapshots of all public problems.
+
+    Unlike update_problem_ranking_snapshots(), rankings of all problems are
+    computed regardless of new solutions, and nothing is written. Problems
+    which already have a snapshot at |snapshot_time| are omitted.
+
+    Args:
+        snapshot_time: Timestamp of the snapshot.
+        num_workers: Number of threads to compute snapshots.
+
+    Returns:
+        A list of problem ranking snapshot dictionaries sorted by problem ID.
+    """
+    assert settings.is_secondary_snapshot_time(snapshot_time)
     cursor = _db.problems.find(
         {
             'public': True,
@@ -1002,22 +2095,22 @@ def update_problem_ranking_snapshots(snapshot_time):
         },
         projection=['_id'])
     problem_ids = [problem['_id'] for problem in cursor]
-    for problem_id in problem_ids:
-        _update_problem_ranking_snapshot(snapshot_time, problem_id)
+    snapshots = list(_compute_problem_ranking_snapshots(
+        snapshot_time, problem_ids, num_workers))
+    snapshots.sort(key=lambda snapshot: snapshot['problem_id'])
+    return snapshots
 
 
-def get_last_leaderboard_snapshot(public_only):
-    """Returns the last leaderboard snapshot.
+def get_last_leaderboard_snapshot_time(public_only):
+    """Returns the timestamp of the last leaderboard snapshot.
+
+    This is cheaper than get_last_leaderboard_snapshot().
 
     Args:
         public_only: If true, only public snapshots are considered.
 
     Returns:
-        (snapshot_time, ranking)
-        ranking = [
-           {'username': ..., 'score': ...},
-           ...
-        ]
+        Timestamp of the snapshot.
     """
     query = {
         'snapshot_time': {
@@ -1028,22 +2121,124 @@ def get_last_leaderboard_snapshot(public_only):
         query['public'] = True
     snapshot = _db.leaderboard_snapshots.find_one(
         query,
+        projection=['snapshot_time'],
         sort=[('snapshot_time', pymongo.DESCENDING)])
     if not snapshot:
-        return (FLAGS.contest_start_time, [])
-    return (snapshot['snapshot_time'], snapshot['ranking'])
+        return FLAGS.contest_start_time
+    return snapshot['snapshot_time']
 
 
-def update_leaderboard_snapshot(snapshot_time):
-    """Updates leaderboard.
+def get_last_leaderboard_snapshot(public_only, copy=True):
+    """Returns the last leaderboard snapshot.
 
-    This function must be called after update_problem_rankings() with the same
-    |snapshot_time|.
+    Snapshots are cached in the process memory until a newer one is found.
 
     Args:
-        snapshot_time: Timestamp of the snapshot.
+        public_only: If true, only public snapshots are considered.
+        copy: If false, the cached ranking is returned as is, so that callers
+            only reading the snapshot time do not pay for copying it. It must
+            not be modified then.
+
+    Returns:
+        (snapshot_time, ranking)
+        ranking = [
+           {'username': ..., 'score': ...},
+           ...
+        ]
     """
-    assert settings.is_secondary_snapshot_time(snapshot_time)
+    def load_snapshot():
+        query = {
+            'snapshot_time': {
+                '$lte': misc_util.time(),
+            },
+        }
+        if public_only:
+            query['public'] = True
+        snapshot = _db.leaderboard_snapshots.find_one(
+            query,
+            sort=[('snapshot_time', pymongo.DESCENDING)])
+        if not snapshot:
+            return (FLAGS.contest_start_time, [])
+        return (snapshot['snapshot_time'], snapshot['ranking'])
+
+    return _get_cached_snapshot(
+        ('leaderboard', public_only),
+        lambda: get_last_leaderboard_snapshot_time(public_only),
+        load_snapshot,
+        copy=copy)
+
+
+def _get_snapshot_cache():
+    global _snapshot_cache
+    with _snapshot_cache_lock:
+        if _snapshot_cache is None:
+            _snapshot_cache = misc_util.LRUCache(
+                max_entries=FLAGS.snapshot_cache_max_entries)
+        return _snapshot_cache
+
+
+def _get_cached_snapshot(cache_key, get_snapshot_time, load_snapshot, copy=True):
+    """Returns the last snapshot, reusing the cached one if it is up to date.
+
+    A cached snapshot is fresh if no snapshot can be newer than it, i.e. it
+    was taken at the last secondary snapshot time. Otherwise its time is
+    compared with get_snapshot_time() at most once in
+    _SNAPSHOT_CACHE_CHECK_INTERVAL seconds, and the snapshot is reloaded if
+    they differ.
+
+    Args:
+        cache_key: Cache key of the snapshot.
+        get_snapshot_time: Function returning the time of the last snapshot.
+        load_snapshot: Function returning (snapshot_time, ranking) of the
+            last snapshot.
+        copy: If false, the cached ranking is returned without copying.
+
+    Returns:
+        (snapshot_time, ranking). If copy is true, entries of the ranking are
+        copies and can be modified by callers.
+    """
+    if FLAGS.disable_model_cache_for_testing:
+        return load_snapshot()
+    cache = _get_snapshot_cache()
+    now = misc_util.time()
+    entry = cache.get(cache_key)
+    if entry is not None:
+        snapshot_time, ranking, check_time = entry
+        if not (snapshot_time >= settings.get_last_secondary_snapshot_time() or
+                now < check_time + _SNAPSHOT_CACHE_CHECK_INTERVAL):
+            if get_snapshot_time() == snapshot_time:
+                cache.put(cache_key, (snapshot_time, ranking, now))
+            else:
+                entry = None
+    if entry is None:
+        snapshot_time, ranking = load_snapshot()
+        cache.put(cache_key, (snapshot_time, ranking, now))
+    if not copy:
+        return (snapshot_time, ranking)
+    return (snapshot_time, [dict(e) for e in ranking])
+
+
+def _get_problem_team_scores(snapshot, leaderboard_snapshot_time):
+    """Returns score contributions of a problem to a leaderboard.
+
+    Args:
+        snapshot: A problem ranking snapshot dictionary.
+        leaderboard_snapshot_time: Timestamp of the leaderboard.
+
+    Returns:
+        A dictionary mapping usernames to scores.
+    """
+    # Do not include scores for problems published at the snapshot time.
+    if snapshot['problem']['publish_time'] == leaderboard_snapshot_time:
+        return {}
+    if 'team_scores' in snapshot:
+        return snapshot['team_scores']
+    return scoring.compute_team_scores_for_problem(
+        snapshot['problem'], snapshot['ranking'])
+
+
+def _compute_team_scores(snapshot_time):
+    """Computes team scores from all problem ranking snapshots."""
     cursor = _db.problem_ranking_snapshots.find({'snapshot_time': snapshot_time})
     all_users = get_all_users()
     team_scores = {
@@ -1051,15 +2246,89 @@ def update_leaderboard_snapshot(snapshot_time):
         for user in all_users
     }
     organizers = [user['_id'] for user in all_users if user['organizer']]
-    for snapshot in cursor:
-        # Do not include scores for problems published at the snapshot time.
-        if snapshot['problem']['publish_time'] == snapshot_time:
-            continue
-        for username, score in scoring.compute_team_scores_for_problem(
-                snapshot['problem'], snapshot['ranking']).iteritems():
+    for snapshot in _iter_resolved_problem_ranking_snapshots(cursor):
+        for username, score in _get_problem_team_scores(
+                snapshot, snapshot_time).iteritems():
             team_scores[username] += score
     for username in organizers:
         del team_scores[username]
+    return team_scores
+
+
+def _compute_team_scores_incrementally(snapshot_time, last_leaderboard):
+    """Computes team scores by applying changes since the last leaderboard.
+
+    Only problems whose ranking changed since the last leaderboard, or which
+    started counting at this snapshot, are looked at.
+    """
+    last_snapshot_time = last_leaderboard['snapshot_time']
+    team_scores = {
+        entry['username']: entry['score']
+        for entry in last_leaderboard['ranking']
+    }
+    # Teams registered since the last leaderboard start with zero. Scores of
+    # usernames not in |team_scores| after this (i.e. organizers) are ignored.
+    cursor = _db.users.find(
+        {
+            'create_time': {'$gte': last_snapshot_time},
+            'organizer': False,
+        },
+        projection=['_id'])
+    for user in cursor:
+        team_scores.setdefault(user['_id'], 0.0)
+    snapshots = list(_db.problem_ranking_snapshots.find(
+        {
+            'snapshot_time': snapshot_time,
+            '$or': [
+                {'changed': True},
+                {'problem.publish_time': last_snapshot_time},
+            ],
+        }))
+    if not snapshots:
+        return team_scores
+    cursor = _db.problem_ranking_snapshots.find(
+        {
+            'problem_id': {'$in': [snapshot['problem_id'] for snapshot in snapshots]},
+            'snapshot_time': last_snapshot_time,
+        })
+    last_snapshot_map = {
+        last_snapshot['problem_id']: last_snapshot
+        for last_snapshot in _iter_resolved_problem_ranking_snapshots(cursor)
+    }
+    for snapshot in snapshots:
+        new_scores = _get_problem_team_scores(snapshot, snapshot_time)
+        last_snapshot = last_snapshot_map.get(snapshot['problem_id'])
+        last_scores = (
+            _get_problem_team_scores(last_snapshot, last_snapshot_time)
+            if last_snapshot else {})
+        for username in set(new_scores) | set(last_scores):
+            if username in team_scores:
+                team_scores[username] += (
+                    new_scores.get(username, 0.0) - last_scores.get(username, 0.0))
+    return team_scores
+
+
+def update_leaderboard_snapshot(snapshot_time):
+    """Updates leaderboard.
+
+    This function must be called after update_problem_rankings() with the same
+    |snapshot_time|.
+
+    If the leaderboard of the previous secondary snapshot is available, only
+    changes since then are applied to it. Otherwise it is computed from
+    scratch.
+
+    Args:
+        snapshot_time: Timestamp of the snapshot.
+    """
+    assert settings.is_secondary_snapshot_time(snapshot_time)
+    last_leaderboard = _db.leaderboard_snapshots.find_one(
+        {'_id': snapshot_time - FLAGS.contest_secondary_snapshot_interval})
+    if last_leaderboard:
+        team_scores = _compute_team_scores_incrementally(
+            snapshot_time, last_leaderboard)
+    else:
+        team_scores = _compute_team_scores(snapshot_time)
     ranking = [
         {
             'username': username,
@@ -1067,24 +2336,42 @@ def update_leaderboard_snapshot(snapshot_time):
         }
         for username, score in team_scores.iteritems()
     ]
-    ranking.sort(key=lambda entry: (-entry['score'], entry['username']))
+    # Round scores for ordering so that rounding errors accumulated by
+    # incremental updates do not break ties.
+    ranking.sort(key=lambda entry: (-round(entry['score'], 6), entry['username']))
     public = settings.is_public_leaderboard_snapshot_time(snapshot_time)
-    try:
-        _db.leaderboard_snapshots.update_one(
-            {'_id': snapshot_time},
-            {
-                '$setOnInsert': {
-                    '_id': snapshot_time,
+    _bulk_write_snapshots(
+        _db.leaderboard_snapshots,
+        [
+            pymongo.UpdateOne(
+                {'_id': snapshot_time},
+                {
+                    '$setOnInsert': {
+                        '_id': snapshot_time,
+                    },
+                    '$set': {
+                        'snapshot_time': snapshot_time,
+                        'ranking': ranking,
+                        'public': public,
+                    },
                 },
-                '$set': {
-                    'snapshot_time': snapshot_time,
-                    'ranking': ranking,
-                    'public': public,
-                },
-            },
-            upsert=True)
-    except pymongo.errors.DuplicateKeyError:
-        pass
+                upsert=True),
+        ])
+
+
+def get_last_public_contest_snapshot_time():
+    """Returns the timestamp of the last public contest snapshot.
+
+    Returns:
+        Timestamp of the snapshot, or None if there is no snapshot.
+    """
+    snapshot = _db.public_contest_snapshots.find_one(
+        {},
+        projection=['snapshot_time'],
+        sort=[('snapshot_time', pymongo.DESCENDING)])
+    if not snapshot:
+        return None
+    return snapshot['snapshot_time']
 
 
 def get_public_contest_snapshots():
@@ -1131,7 +2418,7 @@ def update_public_contest_snapshot(snapshot_time):
                 'public': True,
                 'snapshot_time': snapshot_time,
             })
-        for snapshot in cursor:
+        for snapshot in _iter_resolved_problem_ranking_snapshots(cursor):
             problem = {
                 'problem_id': snapshot['problem']['_id'],
                 'publish_time': snapshot['problem']['publish_time'],
@@ -1178,6 +2465,52 @@ def update_public_contest_snapshot(snapshot_time):
         pass
 
 
+def _remove_snapshots(stale_time, keep_public):
+    """Removes problem ranking and leaderboard snapshots older than a time.
+
+    Problem ranking snapshots still referred to by remaining ones are kept.
+
+    Args:
+        stale_time: Timestamp. Snapshots older than this are removed.
+        keep_public: If true, public snapshots are kept.
+    """
+    remove_query = {'snapshot_time': {'$lt': stale_time}}
+    referring_query = {'snapshot_time': {'$gte': stale_time}}
+    if keep_public:
+        remove_query['public'] = False
+        referring_query = {
+            '$or': [
+                referring_query,
+                {'public': True, 'base_id': {'$exists': True}},
+            ],
+        }
+    referred_ids = _db.problem_ranking_snapshots.distinct(
+        'base_id', referring_query)
+    _bulk_write_snapshots(
+        _db.problem_ranking_snapshots,
+        [
+            pymongo.DeleteMany(
+                dict(remove_query, _id={'$nin': referred_ids})),
+        ])
+    _bulk_write_snapshots(
+        _db.leaderboard_snapshots,
+        [
+            pymongo.DeleteMany(remove_query),
+        ])
+
+
+def remove_secondary_snapshots(stale_time):
+    """Removes old non-public snapshots.
+
+    Public snapshots are kept as they are shown to contestants.
+
+    Args:
+        stale_time: Timestamp. Non-public snapshots older than this timestamp
+            will be removed.
+    """
+    _remove_snapshots(stale_time, keep_public=True)
+
+
 def remove_stale_snapshots_for_demo(stale_time):
     """Removes stale snapshots.
 
@@ -1187,18 +2520,15 @@ def remove_stale_snapshots_for_demo(stale_time):
         stale_time: Timestamp. Snapshots with older than this timestamp
             will be removed.
     """
-    _db.problem_ranking_snapshots.delete_many(
-        {
-            'snapshot_time': {'$lt': stale_time},
-        })
-    _db.leaderboard_snapshots.delete_many(
-        {
-            'snapshot_time': {'$lt': stale_time},
-        })
-    _db.public_contest_snapshots.delete_many(
-        {
-            'snapshot_time': {'$lt': stale_time},
-        })
+    _remove_snapshots(stale_time, keep_public=False)
+    _bulk_write_snapshots(
+        _db.public_contest_snapshots,
+        [
+            pymongo.DeleteMany(
+                {
+                    'snapshot_time': {'$lt': stale_time},
+                }),
+        ])
 
 
 def lock_snapshot_cron_job(snapshot_time):
@@ -1210,31 +2540,82 @@ def lock_snapshot_cron_job(snapshot_time):
     Returns:
         True if a lock is acquired. Otherwise False.
     """
+    locked_time = misc_util.time()
+    # Cron jobs only lock the current snapshot times, so a lock can expire
+    # once its snapshot time is over.
+    expire_time = datetime.datetime.utcfromtimestamp(
+        locked_time + FLAGS.contest_primary_snapshot_interval * 2)
     try:
         _db.cron_locks.insert_one({
             '_id': 'snapshot:%d' % snapshot_time,
-            'locked_time': misc_util.time(),
+            'locked_time': locked_time,
+            'expire_time': expire_time,
         })
     except pymongo.errors.DuplicateKeyError:
         return False
     return True
 
 
+def _get_last_solution_counts(problem_ids):
+    """Returns solution counts in the last problem ranking snapshots.
+
+    Args:
+        problem_ids: A list of numeric problem IDs.
+
+    Returns:
+        A dictionary mapping problem IDs to
+        (solution_count, perfect_solution_count). Problems without snapshots
+        are missing.
+    """
+    projection = [
+        '_id', 'problem_id', 'base_id',
+        'solution_count', 'perfect_solution_count']
+    # Problem ranking snapshots are written before the leaderboard snapshot,
+    # so most problems have a snapshot at its time.
+    last_snapshot_time = get_last_leaderboard_snapshot_time(public_only=False)
+    cursor = _db.problem_ranking_snapshots.find(
+        {
+            '_id': {
+                '$in': ['%d:%d' % (problem_id, last_snapshot_time)
+                        for problem_id in problem_ids],
+            },
+        },
+        projection=projection)
+    last_snapshots = list(cursor)
+    found_problem_ids = set(
+        last_snapshot['problem_id'] for last_snapshot in last_snapshots)
+    for problem_id in problem_ids:
+        if problem_id not in found_problem_ids:
+            last_snapshot = _db.problem_ranking_snapshots.find_one(
+                {'problem_id': problem_id},
+                projection=projection,
+                sort=[('snapshot_time', pymongo.DESCENDING)])
+            if last_snapshot:
+                last_snapshots.append(last_snapshot)
+    counts = {}
+    legacy_snapshot_ids = []
+    for last_snapshot in last_snapshots:
+        if last_snapshot.get('solution_count') is None:
+            legacy_snapshot_ids.append(last_snapshot['_id'])
+        else:
+            counts[last_snapshot['problem_id']] = (
+                last_snapshot['solution_count'],
+                last_snapshot['perfect_solution_count'])
+    # Snapshots written by old versions lack counts, so count their rankings.
+    if legacy_snapshot_ids:
+        cursor = _db.problem_ranking_snapshots.find(
+            {'_id': {'$in': legacy_snapshot_ids}})
+        for snapshot in _iter_resolved_problem_ranking_snapshots(cursor):
+            counts[snapshot['problem_id']] = _count_ranked_solutions(
+                snapshot['ranking'])
+    return counts
+
+
 def enhance_problems_for_admin(problems):
+    counts = _get_last_solution_counts(
+        [problem['_id'] for problem in problems])
     for problem in problems:
-        query = {
-            'problem_id': problem['_id']
-        }
-        snapshot = _db.problem_ranking_snapshots.find_one(
-            query,
-            sort=[('snapshot_time', pymongo.DESCENDING)])
-        if snapshot is None:
-            problem["solution_count"] = 0
-            problem["perfect_solution_count"] = 0
-        else:
-            problem["solution_count"] = len(snapshot["ranking"])
-            perfect_solution_count = 0
-            for solution in snapshot["ranking"]:
-                if solution["resemblance_int"] == 1000000:
-                    perfect_solution_count += 1
-            problem["perfect_solution_count"] = perfect_solution_count
+        solution_count, perfect_solution_count = counts.get(
+            problem['_id'], (0, 0))
+        problem["solution_count"] = solution_count
+        problem["perfect_solution_count"] = perfect_solution_count
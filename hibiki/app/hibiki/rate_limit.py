@@ -0,0 +1,247 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rate limit bookkeeping with pluggable backends.
+
+The "mongodb" backend keeps all state in MongoDB. The "memory" backend keeps
+it in the process memory, so it enforces the limits per process and is
+refused when uWSGI runs multiple workers. The "uwsgi" backend keeps it in the
+uWSGI cache shared by the workers on the host, and enforces the limits per
+host. Optionally, API rate limit windows of these backends are reconciled
+with MongoDB every --rate_limit_mongodb_sync_interval seconds so that the
+limits hold across processes and hosts.
+"""
+
+import contextlib
+import threading
+import zlib
+
+import gflags
+import ujson
+
+from hibiki import misc_util
+from hibiki import model
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_enum(
+    'rate_limit_backend', 'mongodb', ['mongodb', 'memory', 'uwsgi'],
+    'Where rate limit state is kept. "memory" is per process and works only '
+    'with a single worker, "uwsgi" is shared by the workers on the host and '
+    'requires the uWSGI cache named by --rate_limit_uwsgi_cache and '
+    '--rate_limit_uwsgi_locks uWSGI locks.')
+gflags.DEFINE_string(
+    'rate_limit_uwsgi_cache', 'rate_limits',
+    'Name of the uWSGI cache used by the "uwsgi" rate limit backend.')
+gflags.DEFINE_integer(
+    'rate_limit_uwsgi_locks', 64,
+    'Number of uWSGI locks the "uwsgi" rate limit backend spreads users over. '
+    'uWSGI must be started with at least this many --locks.')
+gflags.DEFINE_float(
+    'rate_limit_mongodb_sync_interval', 0,
+    'If positive, API rate limit windows of the "memory" and "uwsgi" '
+    'backends are reconciled with MongoDB at this interval in seconds.')
+
+# The number of writes between sweeps of expired entries in _ProcessStore.
+_SWEEP_INTERVAL = 1024
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class _ProcessStore(object):
+    """Expiring key-value store in the process memory."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def lock(self, name):
+        return self._lock
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= misc_util.time():
+            return None
+        return entry[0]
+
+    def set(self, key, value, ttl):
+        now = misc_util.time()
+        self._entries[key] = (value, now + ttl)
+        self._writes += 1
+        if self._writes % _SWEEP_INTERVAL == 0:
+            for expired_key in [k for k, (_, expire_time) in
+                                self._entries.iteritems()
+                                if expire_time <= now]:
+                del self._entries[expired_key]
+
+
+class _UWSGIStore(object):
+    """Expiring key-value store in the uWSGI cache shared by workers."""
+
+    def __init__(self, cache_name, num_locks):
+        import uwsgi
+        self._uwsgi = uwsgi
+        self._cache_name = cache_name
+        self._num_locks = num_locks
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        # Lock 0 is the global lock of uwsgi.lock(), so use 1..num_locks.
+        # crc32 is stable across worker processes unlike hash().
+        lock_num = 1 + (
+            zlib.crc32(name.encode('utf-8')) & 0xffffffff) % self._num_locks
+        self._uwsgi.lock(lock_num)
+        try:
+            yield
+        finally:
+            self._uwsgi.unlock(lock_num)
+
+    def get(self, key):
+        data = self._uwsgi.cache_get(key, self._cache_name)
+        if data is None:
+            return None
+        # Expiration in the uWSGI cache is lazy, so check it here.
+        value, expire_time = ujson.loads(data)
+        if expire_time <= misc_util.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        data = ujson.dumps([value, misc_util.time() + ttl])
+        self._uwsgi.cache_update(
+            key, data, int(ttl) + 1, self._cache_name)
+
+
+def validate():
+    """Validates the rate limit backend can enforce the limits.
+
+    Raises:
+        ValueError: If the "memory" backend is used by multiple uWSGI workers.
+    """
+    if FLAGS.rate_limit_backend != 'memory':
+        return
+    try:
+        import uwsgi
+    except ImportError:
+        return
+    if uwsgi.numproc > 1:
+        raise ValueError(
+            'rate_limit_backend=memory enforces limits per process; use '
+            'rate_limit_backend=uwsgi with multiple uWSGI workers')
+
+
+def _get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if FLAGS.rate_limit_backend == 'uwsgi':
+                _store = _UWSGIStore(
+                    FLAGS.rate_limit_uwsgi_cache, FLAGS.rate_limit_uwsgi_locks)
+            else:
+                _store = _ProcessStore()
+        return _store
+
+
+def record_api_request(username, action):
+    """Records an API request for rate limiting.
+
+    A request must come --api_rate_limit_request_interval seconds after the
+    last one, and requests are counted in a window whose length is defined
+    by --api_rate_limit_window_size.
+
+    Args:
+        username: Username.
+        action: Action name.
+
+    Returns:
+        The number of requests of the action in the current window including
+        this one, or None if the request came too soon after the last one.
+        Such requests are not counted.
+    """
+    if FLAGS.rate_limit_backend == 'mongodb':
+        return model.record_api_request(username, action)
+    store = _get_store()
+    now = misc_util.time()
+    window_time = misc_util.align_timestamp(
+        now, FLAGS.contest_start_time, FLAGS.api_rate_limit_window_size)
+    last_access_key = 'api_last_access:%s' % username
+    key = 'api:%s:%d:%s' % (action, window_time, username)
+    ttl = window_time + FLAGS.api_rate_limit_window_size - now
+    sync_interval = FLAGS.rate_limit_mongodb_sync_interval
+    # |synced| is the count in MongoDB when it was last read, and |pending|
+    # is the count of local requests not yet added to MongoDB.
+    with store.lock(username):
+        last_access_time = store.get(last_access_key)
+        if (last_access_time is not None and
+                now - last_access_time < FLAGS.api_rate_limit_request_interval):
+            return None
+        store.set(
+            last_access_key, now,
+            max(60, FLAGS.api_rate_limit_request_interval * 2))
+        synced, pending, last_sync_time = store.get(key) or (0, 0, None)
+        pending += 1
+        push = 0
+        if sync_interval > 0 and (
+                last_sync_time is None or now - last_sync_time >= sync_interval):
+            push, pending, last_sync_time = pending, 0, now
+        store.set(key, (synced, pending, last_sync_time), ttl)
+    if not push:
+        return synced + pending
+    synced = model.increment_api_rate_limit_counter(
+        username, action, push, window_time)
+    with store.lock(username):
+        _, pending, last_sync_time = store.get(key) or (0, 0, now)
+        store.set(key, (synced, pending, last_sync_time), ttl)
+    return synced + pending
+
+
+def decrement_web_rate_limit_counter(username):
+    """Decrements web rate limit counter.
+
+    Web rate limit is implemented by token bucket method.
+
+    Args:
+        username: Username.
+
+    Returns:
+        True if the request is allowed, otherwise False.
+    """
+    if FLAGS.rate_limit_backend == 'mongodb':
+        return model.decrement_web_rate_limit_counter(username)
+    store = _get_store()
+    key = 'web:%s' % username
+    burst = FLAGS.web_rate_limit_allowed_burst_requests
+    rate = FLAGS.web_rate_limit_requests_per_minute
+    if rate > 0:
+        # A bucket is full again after this, so it can be forgotten.
+        ttl = burst * 60.0 / rate + 1
+    else:
+        # A bucket is never refilled, so keep it until the contest ends.
+        ttl = max(60, FLAGS.contest_end_time - misc_util.time())
+    with store.lock(username):
+        current_time_millis = int(misc_util.time() * 1000)
+        tokens, last_access_time_millis = (
+            store.get(key) or (burst, current_time_millis))
+        if last_access_time_millis < current_time_millis:
+            delta_minutes = (
+                (current_time_millis - last_access_time_millis) / 60000.0)
+            tokens = min(burst, tokens + rate * delta_minutes)
+            last_access_time_millis = current_time_millis
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        store.set(key, (tokens, last_access_time_millis), ttl)
+    return allowed
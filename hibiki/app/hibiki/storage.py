@@ -14,7 +14,6 @@
 
 import base64
 import cStringIO
-import gzip
 import os
 import urllib
 
@@ -34,6 +33,10 @@ _signer_credentials = None
 _service = None
 _bucket_name = None
 
+# Names of objects known to exist in the bucket. Objects are immutable, so
+# saving them again can be skipped.
+_known_names = misc_util.LRUCache(max_entries=100000)
+
 
 def connect(bucket_name):
     global _signer_credentials
@@ -50,24 +53,23 @@ def connect(bucket_name):
 
 
 def save(name, binary, mimetype):
-    try:
-        request = _service.objects().get(bucket=_bucket_name, object=name)
-        request.execute()
-    except apiclient.errors.HttpError:
-        pass
-    else:
-        # The blob already exists.
+    if _known_names.get(name):
         return
-    buf = cStringIO.StringIO()
-    with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_stream:
-        gzip_stream.write(binary)
-    buf.seek(0)
+    buf = cStringIO.StringIO(misc_util.gzip_compress(binary))
+    # ifGenerationMatch=0 makes the insert fail if the object exists.
     request = _service.objects().insert(
         bucket=_bucket_name,
         name=name,
         media_body=apiclient.http.MediaIoBaseUpload(buf, mimetype=mimetype),
-        contentEncoding='gzip')
-    request.execute(num_retries=3)
+        contentEncoding='gzip',
+        ifGenerationMatch=0)
+    try:
+        request.execute(num_retries=3)
+    except apiclient.errors.HttpError as e:
+        if e.resp.status != 412:
+            raise
+        # The blob already exists.
+    _known_names.put(name, True)
 
 
 def load(name):
@@ -21,6 +21,7 @@ import wsgiprof
 from hibiki import cron_flags as _cron_flags_import_only
 from hibiki import handler as _handler_import_only
 from hibiki import model
+from hibiki import rate_limit
 from hibiki import setup
 
 FLAGS = gflags.FLAGS
@@ -33,6 +34,7 @@ assert __name__ == 'hibiki.wsgi_main'
 app = bottle.default_app()
 
 setup.setup_common()
+rate_limit.validate()
 model.connect()
 
 if FLAGS.profile:
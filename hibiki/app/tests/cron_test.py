@@ -45,3 +45,26 @@ class CronTest(unittest.TestCase):
         assert any(
             u['username'] == common.context.username
             for u in data['users'])
+
+    def test_snapshot_not_modified(self):
+        common.ensure_login()
+        common.ensure_api_key()
+        common.get(
+            '/testing/cron/snapshot_job',
+            headers={'X-Override-Time': '1451610001'})
+        res, data = common.get('/api/snapshot/list', type='json')
+        res = common.context.session.get(
+            'http://localhost:8000/api/snapshot/list',
+            headers={'If-None-Match': res.headers['ETag']})
+        assert res.status_code == 304
+        path = '/api/blob/%s' % data['snapshots'][-1]['snapshot_hash']
+        res, data = common.get(path, type='json')
+        assert 'immutable' in res.headers['Cache-Control']
+        res = common.context.session.get(
+            'http://localhost:8000%s' % path,
+            headers={'If-None-Match': res.headers['ETag']})
+        assert res.status_code == 304
+        res = common.context.session.get(
+            'http://localhost:8000/api/blob/%s' % ('0' * 40),
+            headers={'If-None-Match': '*'})
+        assert res.status_code == 404
@@ -35,3 +35,16 @@ class GzipTest(unittest.TestCase):
         assert cm.exception.response.status_code == 400
         common.context.session.headers['Accept-Encoding'] = 'gzip'
         common.get('/api/hello', type='json')
+
+    def test_blob_served_gzipped(self):
+        common.ensure_login()
+        common.ensure_api_key()
+        common.get(
+            '/testing/cron/snapshot_job',
+            headers={'X-Override-Time': '1451610001'})
+        res, data = common.get('/api/snapshot/list', type='json')
+        snapshot_hash = data['snapshots'][-1]['snapshot_hash']
+        res, data = common.get('/api/blob/%s' % snapshot_hash, type='json')
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert res.headers['ETag'] == '"%s-gzip"' % snapshot_hash
+        assert 'snapshot_time' in data
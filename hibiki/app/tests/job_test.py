@@ -0,0 +1,108 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import unittest
+
+import requests
+
+import common
+
+# A solution spec which is well-formed but does not cover the unit square.
+_INVALID_SOLUTION = '''3
+0,0
+1,0
+0,1
+1
+3 0 1 2
+0,0
+1,0
+0,1
+'''
+
+
+class JobTest(unittest.TestCase):
+    def setUp(self):
+        common.setup()
+        with open(os.path.join(os.path.dirname(__file__), 'sample_solution.txt')) as f:
+            self._sample_solution = f.read()
+
+    def tearDown(self):
+        common.teardown()
+
+    def test_unknown_job(self):
+        common.ensure_login()
+        common.ensure_api_key()
+        with self.assertRaises(requests.HTTPError) as cm:
+            common.get('/api/job/0123456789abcdef', type='json')
+        assert cm.exception.response.status_code == 404
+
+    def submit_problem_async(self, solution_spec):
+        res, data = common.post(
+            '/api/problem/submit',
+            type='json',
+            data={
+                'solution_spec': solution_spec,
+                'publish_time': 1475280000,
+                'async': '1',
+            },
+            headers={
+                'X-Override-Time': '1451606400',
+            })
+        assert data['ok']
+        assert data['status'] == 'pending'
+        return data['job_id']
+
+    def wait_for_job(self, job_id):
+        # Jobs are run by judge_runner_main running next to the app.
+        for _ in xrange(120):
+            res, data = common.get('/api/job/%s' % job_id, type='json')
+            if data['status'] in ('done', 'failed'):
+                return data
+            time.sleep(0.5)
+        assert False, data
+
+    def test_async_problem(self):
+        common.ensure_login()
+        common.ensure_api_key()
+        job_id = self.submit_problem_async(self._sample_solution)
+        data = self.wait_for_job(job_id)
+        assert data['status'] == 'done', data
+        assert data['result']['publish_time'] == 1475280000
+        assert data['result']['problem_id'] > 0
+
+    def test_async_invalid_problem(self):
+        common.ensure_login()
+        common.ensure_api_key()
+        job_id = self.submit_problem_async(_INVALID_SOLUTION)
+        data = self.wait_for_job(job_id)
+        assert data['status'] == 'failed', data
+        assert data['error'].startswith('Invalid solution spec'), data
+        assert 'result' not in data
+
+    def test_stale_job(self):
+        common.ensure_login()
+        common.ensure_api_key()
+        job_id = self.submit_problem_async(self._sample_solution)
+        data = self.wait_for_job(job_id)
+        assert data['status'] == 'done', data
+        problem_id = data['result']['problem_id']
+        # Pretend the runner crashed after registering the problem but before
+        # finishing the job. It is claimed again once it is stale, and
+        # finished without registering another problem.
+        common.get('/testing/judge/abandon_job/%s' % job_id)
+        data = self.wait_for_job(job_id)
+        assert data['status'] == 'done', data
+        assert data['result']['problem_id'] == problem_id
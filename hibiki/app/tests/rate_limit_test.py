@@ -0,0 +1,212 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import gflags
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hibiki import misc_util
+from hibiki import model
+from hibiki import rate_limit
+
+FLAGS = gflags.FLAGS
+
+_FLAGS_ARGV = [
+    'rate_limit_test',
+    '--admin_password=test',
+    '--contest_start_time=0',
+    '--contest_first_publish_time=0',
+    '--contest_freeze_time=3600',
+    '--contest_last_publish_time=3600',
+    '--contest_end_time=3600',
+    '--contest_primary_snapshot_interval=60',
+    '--contest_secondary_snapshot_interval=10',
+    '--api_rate_limit_request_interval=1',
+    '--api_rate_limit_window_size=60',
+    '--api_rate_limit_submissions_in_window=1000',
+    '--api_rate_limit_blob_lookups_in_window=1000',
+    '--web_rate_limit_requests_per_minute=60',
+    '--web_rate_limit_allowed_burst_requests=3',
+    '--rate_limit_mongodb_sync_interval=0',
+    '--rate_limit_uwsgi_locks=8',
+]
+
+
+class _FakeUWSGI(object):
+    """Fake of the uwsgi module with a cache and user locks."""
+
+    def __init__(self, numproc=1):
+        self.numproc = numproc
+        self.caches = {}
+        self.held_locks = []
+        self.taken_locks = []
+
+    def cache_get(self, key, cache_name):
+        return self.caches.get(cache_name, {}).get(key)
+
+    def cache_update(self, key, value, expires, cache_name):
+        self.caches.setdefault(cache_name, {})[key] = value
+
+    def lock(self, lock_num=0):
+        assert lock_num not in self.held_locks
+        self.held_locks.append(lock_num)
+        self.taken_locks.append(lock_num)
+
+    def unlock(self, lock_num=0):
+        self.held_locks.remove(lock_num)
+
+
+class _FakeAPIRateLimitCounters(object):
+    """Fake of model.increment_api_rate_limit_counter() backed by a dict."""
+
+    def __init__(self):
+        self.counts = {}
+        self.calls = []
+
+    def __call__(self, username, action, amount, window_time):
+        self.calls.append((username, action, amount, window_time))
+        key = (username, action, window_time)
+        self.counts[key] = self.counts.get(key, 0) + amount
+        return self.counts[key]
+
+
+class _RateLimitTestBase(object):
+    backend = None
+
+    def setUp(self):
+        FLAGS(_FLAGS_ARGV + ['--rate_limit_backend=%s' % self.backend])
+        self._now = 1000.0
+        self._orig_time = misc_util.time
+        misc_util.time = lambda: self._now
+        self._counters = _FakeAPIRateLimitCounters()
+        self._orig_increment = model.increment_api_rate_limit_counter
+        model.increment_api_rate_limit_counter = self._counters
+        self._uwsgi = _FakeUWSGI()
+        sys.modules['uwsgi'] = self._uwsgi
+        rate_limit._store = None
+        self._other_host = (None, {})
+
+    def tearDown(self):
+        misc_util.time = self._orig_time
+        model.increment_api_rate_limit_counter = self._orig_increment
+        del sys.modules['uwsgi']
+        rate_limit._store = None
+
+    def record(self, dt=0, username='alice', action='submit'):
+        self._now += dt
+        return rate_limit.record_api_request(username, action)
+
+    def allow_web(self, dt=0, username='alice'):
+        self._now += dt
+        return rate_limit.decrement_web_rate_limit_counter(username)
+
+    def switch_host(self):
+        """Swaps the store with the one of another host."""
+        state = (rate_limit._store, dict(self._uwsgi.caches))
+        rate_limit._store, caches = self._other_host
+        self._uwsgi.caches.clear()
+        self._uwsgi.caches.update(caches)
+        self._other_host = state
+
+    def test_request_interval(self):
+        assert self.record() == 1
+        assert self.record(0.5) is None
+        assert self.record(0.5) == 2
+        # Another user is not affected.
+        assert self.record(0, username='bob') == 1
+
+    def test_window(self):
+        assert self.record() == 1
+        assert self.record(1, action='blob') == 1
+        assert self.record(1) == 2
+        # The window starting at 1020 has fresh counts.
+        assert self.record(20) == 1
+        assert self.record(1) == 2
+        assert self._counters.calls == []
+
+    def test_token_bucket(self):
+        assert self.allow_web()
+        assert self.allow_web()
+        assert self.allow_web()
+        assert not self.allow_web()
+        assert not self.allow_web(0.5)
+        # A token is refilled every second.
+        assert self.allow_web(0.5)
+        assert not self.allow_web()
+        assert self.allow_web(0, username='bob')
+        # The bucket does not grow beyond the burst.
+        assert self.allow_web(60)
+        assert self.allow_web()
+        assert self.allow_web()
+        assert not self.allow_web()
+
+    def test_token_bucket_without_refill(self):
+        FLAGS.web_rate_limit_requests_per_minute = 0
+        assert self.allow_web()
+        assert self.allow_web()
+        assert self.allow_web()
+        assert not self.allow_web()
+        assert not self.allow_web(600)
+
+    def test_mongodb_sync(self):
+        FLAGS.rate_limit_mongodb_sync_interval = 10
+        # The first request in a window is pushed immediately.
+        assert self.record() == 1
+        assert self.record(1) == 2
+        assert self.record(1) == 3
+        assert self._counters.calls == [('alice', 'submit', 1, 960)]
+        # Another host sees the requests pushed so far.
+        self.switch_host()
+        assert self.record(1) == 2
+        # The requests held locally are pushed after the sync interval, and
+        # the request pushed by the other host is merged.
+        self.switch_host()
+        assert self.record(9) == 5
+        assert self._counters.calls[-1] == ('alice', 'submit', 3, 960)
+        assert self._counters.counts[('alice', 'submit', 960)] == 5
+
+
+class MemoryRateLimitTest(_RateLimitTestBase, unittest.TestCase):
+    backend = 'memory'
+
+    def test_validate(self):
+        rate_limit.validate()
+        self._uwsgi.numproc = 2
+        with self.assertRaises(ValueError):
+            rate_limit.validate()
+
+
+class UWSGIRateLimitTest(_RateLimitTestBase, unittest.TestCase):
+    backend = 'uwsgi'
+
+    def test_validate(self):
+        self._uwsgi.numproc = 2
+        rate_limit.validate()
+
+    def test_per_user_locks(self):
+        self.record(username='alice')
+        self.record(username='alice')
+        self.allow_web(username='alice')
+        alice_locks = set(self._uwsgi.taken_locks)
+        assert len(alice_locks) == 1
+        del self._uwsgi.taken_locks[:]
+        for i in xrange(100):
+            self.record(username='user%d' % i)
+        assert 0 not in self._uwsgi.taken_locks
+        assert set(self._uwsgi.taken_locks) == set(xrange(1, 9))
+        assert self._uwsgi.held_locks == []
@@ -0,0 +1,69 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+import common
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        common.setup()
+        with open(os.path.join(os.path.dirname(__file__), 'sample_solution.txt')) as f:
+            self._sample_solution = f.read()
+
+    def tearDown(self):
+        common.teardown()
+
+    def test_parallel_problem_rankings(self):
+        common.ensure_login()
+        common.ensure_api_key()
+        res, data = common.post(
+            '/api/problem/submit',
+            type='json',
+            data={
+                'solution_spec': self._sample_solution,
+                'publish_time': 1475283600,
+            },
+            headers={'X-Override-Time': '1451606400'})
+        problem_id = data['problem_id']
+        common.get(
+            '/testing/cron/snapshot_job',
+            headers={'X-Override-Time': '1475283601'})
+        # Solutions are submitted by another team.
+        common.context = common.Context()
+        common.ensure_login()
+        common.ensure_api_key()
+        for current_time in (1475283610, 1475283620):
+            common.post(
+                '/api/solution/submit',
+                type='json',
+                data={
+                    'problem_id': problem_id,
+                    'solution_spec': self._sample_solution,
+                },
+                headers={'X-Override-Time': '%d' % current_time})
+        results = []
+        for workers in (1, 4):
+            res, data = common.get(
+                '/testing/snapshot/problem_rankings',
+                type='json',
+                params={'snapshot_time': 1475287200, 'workers': workers})
+            results.append(data['snapshots'])
+        assert results[0] == results[1]
+        assert any(
+            snapshot['problem_id'] == problem_id and
+            snapshot['ranking'][0]['owner'] == common.context.username
+            for snapshot in results[0])
@@ -0,0 +1,160 @@
+# Copyright 2016 ICFP Programming Contest 2016 Organizers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import BaseHTTPServer
+import gzip
+import json
+import os
+import StringIO
+import sys
+import threading
+import unittest
+import urlparse
+
+import apiclient.discovery
+import httplib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hibiki import misc_util
+from hibiki import storage
+
+
+def _make_discovery_document(root_url):
+    """Returns a minimal discovery document of the GCS JSON API."""
+    string_param = lambda location: {'type': 'string', 'location': location}
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'storage:v1',
+        'name': 'storage',
+        'version': 'v1',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': 'storage/v1/',
+        'baseUrl': root_url + 'storage/v1/',
+        'batchPath': 'batch',
+        'parameters': {},
+        'schemas': {
+            'Object': {
+                'id': 'Object',
+                'type': 'object',
+                'properties': {'name': {'type': 'string'}},
+            },
+        },
+        'resources': {
+            'objects': {
+                'methods': {
+                    'insert': {
+                        'id': 'storage.objects.insert',
+                        'path': 'b/{bucket}/o',
+                        'httpMethod': 'POST',
+                        'parameters': {
+                            'bucket': dict(string_param('path'), required=True),
+                            'name': string_param('query'),
+                            'contentEncoding': string_param('query'),
+                            'ifGenerationMatch': dict(
+                                string_param('query'), format='int64'),
+                        },
+                        'parameterOrder': ['bucket'],
+                        'request': {'$ref': 'Object'},
+                        'response': {'$ref': 'Object'},
+                        'supportsMediaUpload': True,
+                        'mediaUpload': {
+                            'accept': ['*/*'],
+                            'protocols': {
+                                'simple': {
+                                    'multipart': True,
+                                    'path': '/upload/storage/v1/b/{bucket}/o',
+                                },
+                            },
+                        },
+                    },
+                },
+            },
+        },
+    }
+
+
+class _FakeGCSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path))
+        if self.path == '/discovery/storage/v1':
+            self._respond(200, _make_discovery_document(
+                'http://localhost:%d/' % self.server.server_port))
+        else:
+            self._respond(404, {'error': {'code': 404, 'message': 'Not Found'}})
+
+    def do_POST(self):
+        self.server.requests.append(('POST', self.path))
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        name = params['name'][0]
+        if params.get('ifGenerationMatch') == ['0'] and name in self.server.objects:
+            self._respond(412, {'error': {'code': 412, 'message': 'Precondition Failed'}})
+            return
+        self.server.objects[name] = body
+        self._respond(200, {'name': name})
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self._server = BaseHTTPServer.HTTPServer(('localhost', 0), _FakeGCSHandler)
+        self._server.requests = []
+        self._server.objects = {}
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        storage._service = apiclient.discovery.build(
+            'storage', 'v1', http=httplib2.Http(),
+            discoveryServiceUrl=(
+                'http://localhost:%d/discovery/{api}/{apiVersion}' %
+                self._server.server_port))
+        storage._bucket_name = 'test-bucket'
+        storage._known_names = misc_util.LRUCache(max_entries=100)
+        del self._server.requests[:]
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def test_save(self):
+        storage.save('blobs/a', 'hello', mimetype='text/plain')
+        assert len(self._server.requests) == 1
+        assert self._server.requests[0][0] == 'POST'
+        data = self._server.objects['blobs/a']
+        assert gzip.GzipFile(fileobj=StringIO.StringIO(data)).read() == 'hello'
+        # Known names are not sent again.
+        storage.save('blobs/a', 'hello', mimetype='text/plain')
+        assert len(self._server.requests) == 1
+
+    def test_save_existing(self):
+        self._server.objects['blobs/b'] = 'existing'
+        storage.save('blobs/b', 'hello', mimetype='text/plain')
+        assert len(self._server.requests) == 1
+        assert self._server.objects['blobs/b'] == 'existing'
+        storage.save('blobs/b', 'hello', mimetype='text/plain')
+        assert len(self._server.requests) == 1